@@ -0,0 +1,140 @@
+from typing import Callable, Dict, List, Optional
+from collections import defaultdict
+
+from data_structures.utils import get_name_parts
+from doublemetaphone import doublemetaphone
+
+import string
+
+
+def phonetic(word: Optional[str]) -> Optional[str]:
+    """Primary double metaphone code of a word"""
+    if not word:
+        return None
+    word = word.strip(string.whitespace + string.punctuation)
+    if len(word) == 0:
+        return None
+    return doublemetaphone(word)[0] or None
+
+
+def _name_parts(entity_dict: dict) -> Dict[str, Optional[str]]:
+    try:
+        parts = get_name_parts(entity_dict["name"])
+    except (IndexError, AttributeError):
+        parts = {}
+    return {"last": entity_dict.get("last_name") or parts.get("last"),
+            "first": entity_dict.get("first_name") or parts.get("first")}
+
+
+def last_name_first_initial(entity_dict: dict) -> Optional[str]:
+    parts = _name_parts(entity_dict)
+    code = phonetic(parts["last"])
+    first = (parts["first"] or "").strip()
+    if code is None or len(first) == 0:
+        return None
+    return f"ln:{code}|fi:{first[0]}"
+
+
+def last_name_zip(entity_dict: dict) -> Optional[str]:
+    code = phonetic(_name_parts(entity_dict)["last"])
+    zipcode = str(entity_dict.get("zipcode") or "").strip()
+    if code is None or len(zipcode) < 3:
+        return None
+    return f"ln:{code}|zip:{zipcode[:3]}"
+
+
+def name_token_state(entity_dict: dict) -> Optional[str]:
+    tokens = str(entity_dict.get("name") or "").split()
+    code = phonetic(tokens[0]) if len(tokens) else None
+    state = entity_dict.get("state") or entity_dict.get("hq_state")
+    if code is None:
+        return None
+    return f"nt:{code}|st:{state}"
+
+
+# Entities land in one block per key, so a pair is compared if it shares any
+INDIVIDUAL_KEYS = [last_name_first_initial, last_name_zip]
+DEFAULT_KEYS = [name_token_state]
+
+
+class Blocker:
+
+    def __init__(self, max_block_size: int = 2000, key_funcs: Optional[
+                 Dict[str, List[Callable[[dict], Optional[str]]]]] = None):
+        """Assigns entities to blocks by cheap keys so that similarity is only
+        scored between entities sharing a block
+        Args:
+            max_block_size: Blocks with more members than this are too
+                unspecific and are no longer used to find candidates
+            key_funcs: Functions deriving block keys from an entity's
+                properties, by entity type. Types not given use DEFAULT_KEYS
+        """
+        self.max_block_size = max_block_size
+        self.key_funcs = key_funcs or {"individual": INDIVIDUAL_KEYS}
+        self._blocks = defaultdict(list)
+        self.oversized = set()
+        self.queries = 0
+        self.compared = 0
+        self.possible = 0
+        self.true_pairs = 0
+        self.missed_pairs = 0
+
+    def keys(self, entity_dict: dict) -> List[str]:
+        entity_type = entity_dict["entity_type"]
+        funcs = self.key_funcs.get(entity_type, DEFAULT_KEYS)
+        keys = [func(entity_dict) for func in funcs]
+        return [f"{entity_type}|{key}" for key in keys if key is not None]
+
+    def add(self, positions: List[int], metadata: List[dict]):
+        """Add entities to their blocks
+        Args:
+            positions: Handle of each entity, returned by `candidates`
+            metadata: Node properties of each entity
+        """
+        for position, entity_dict in zip(positions, metadata):
+            for key in self.keys(entity_dict):
+                block = self._blocks[key]
+                block.append(position)
+                if len(block) > self.max_block_size:
+                    self.oversized.add(key)
+
+    def candidates(self, entity_dict: dict, num_same_type: int) -> List[int]:
+        """Handles of the entities sharing a usable block with the entity
+        Args:
+            entity_dict: Node properties of the entity
+            num_same_type: Number of entities of the same type, for stats
+        """
+        candidates = set()
+        for key in self.keys(entity_dict):
+            if key not in self.oversized:
+                candidates.update(self._blocks.get(key, []))
+        self.queries += 1
+        self.compared += len(candidates)
+        self.possible += num_same_type
+        return sorted(candidates)
+
+    def record_recall(self, true_pairs: int, missed_pairs: int):
+        """Record pairs above threshold found by a full search and how many
+        of those didn't share a block"""
+        self.true_pairs += true_pairs
+        self.missed_pairs += missed_pairs
+
+    @property
+    def pruning_rate(self) -> Optional[float]:
+        return 1 - self.compared / self.possible if self.possible else None
+
+    @property
+    def recall(self) -> Optional[float]:
+        if self.true_pairs == 0:
+            return None
+        return 1 - self.missed_pairs / self.true_pairs
+
+    def __str__(self):
+        pruning = self.pruning_rate
+        pruning = "n/a" if pruning is None else f"{100 * pruning:.2f}%"
+        recall = self.recall
+        recall = "n/a" if recall is None else f"{100 * recall:.2f}%"
+        return f"Blocking: {len(self._blocks)} blocks, {len(self.oversized)} "\
+            f"over the size cap, {self.queries} queries, {self.compared} of "\
+            f"{self.possible} comparisons ({pruning} pruned), sampled recall "\
+            f"{recall} ({self.missed_pairs} of {self.true_pairs} pairs lost)"
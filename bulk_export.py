@@ -0,0 +1,203 @@
+from data_structures.key import ENTITY_CLASSES, RELATIONSHIP_CLASSES
+from graph_schema import entity_label
+
+from typing import Dict, List, get_args
+from dataclasses import fields
+from pathlib import Path
+
+import csv
+import numpy as np
+import pandas as pd
+
+
+# Node properties written ahead of the entity class's own fields
+NODE_COLUMNS = [("entity_id", "ID(Entity)"), ("id", "string"),
+                ("text", "string"), ("embedding", "float[]"),
+                ("batch_seq", "long")]
+
+
+def _neo4j_type(tp) -> str:
+    """Import header type of a dataclass field's annotation"""
+    args = [arg for arg in get_args(tp) if arg is not type(None)]
+    tp = args[0] if len(args) else tp
+    return {int: "long", float: "double", bool: "boolean"}.get(tp, "string")
+
+
+# Python type values of each import header type are converted to before
+# they're written to Parquet, e.g. dates and Decimals from Snowflake
+PYTHON_TYPES = {"string": str, "long": int, "double": float, "boolean": bool}
+
+
+def _coerce(values: list, tp: str) -> list:
+    """Convert values to the Python type of an import header type, keeping
+    nulls as None"""
+    if tp not in PYTHON_TYPES:
+        return values
+    convert = PYTHON_TYPES[tp]
+    return [None if value is None or (isinstance(value, float) and
+                                      value != value) else convert(value)
+            for value in values]
+
+
+def _class_columns(cls, skip: List[str]) -> List[tuple]:
+    return [(f.name, _neo4j_type(f.type)) for f in fields(cls) if f.name
+            not in skip]
+
+
+class BulkExporter:
+
+    def __init__(self, output_dir: str, file_format: str = "csv",
+                 array_delimiter: str = ";"):
+        """Writes entities and relationships to files for the offline
+        `neo4j-admin database import` tool instead of the graph db. One node
+        file per entity type and one relationship file per relationship type
+        are appended to batch by batch, with the column headers in separate
+        header files
+        Args:
+            output_dir: Directory to write the import files to
+            file_format: csv or parquet
+            array_delimiter: Delimiter between the values of the embedding in
+                csv files
+        """
+        if file_format not in ["csv", "parquet"]:
+            raise ValueError(f"Unknown file format {file_format}")
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.file_format = file_format
+        self.array_delimiter = array_delimiter
+        self._columns = {}
+        self._writers = {}
+        self._files = {}
+        self._written_ids = set()
+        self.batch_seq = 0
+        self.nodes = 0
+        self.relationships = 0
+        self.duplicates = 0
+
+    def _path(self, name: str) -> Path:
+        return self.output_dir / f"{name}.{self.file_format}"
+
+    def _header(self, name: str) -> List[str]:
+        return [f"{column}:{tp}" if tp != "string" else column for column, tp
+                in self._columns[name]]
+
+    def _write(self, name: str, columns: List[tuple], rows: Dict[str, list]):
+        """Append rows, given as a list of values per column, to a file"""
+        self._columns.setdefault(name, columns)
+        if self.file_format == "csv":
+            if name not in self._writers:
+                self._files[name] = open(self._path(name), "w", newline="")
+                self._writers[name] = csv.writer(self._files[name])
+            array_columns = [column for column, tp in columns if
+                             tp.endswith("[]")]
+            for column in array_columns:
+                rows[column] = [self.array_delimiter.join(map(str, value)) for
+                                value in rows[column]]
+            self._writers[name].writerows(zip(*[rows[column] for column, _ in
+                                                columns]))
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            types = {"long": pa.int64(), "double": pa.float64(),
+                     "boolean": pa.bool_(), "float[]": pa.list_(pa.float32())}
+            header = dict(zip([column for column, _ in columns],
+                              self._header(name)))
+            table = pa.table({header[column]: pa.array(
+                _coerce(rows[column], tp), types.get(tp, pa.string())) for
+                column, tp in columns})
+            if name not in self._writers:
+                self._writers[name] = pq.ParquetWriter(self._path(name),
+                                                       table.schema)
+            self._writers[name].write_table(table)
+
+    def write_nodes(self, entity_ids: List[str], texts: List[str],
+                    metadata: List[dict], embeddings: List[np.array]):
+        """Write one batch of entities as nodes, skipping ids already written.
+        The batch is given the next batch_seq, as the graph's watermark would"""
+        self.batch_seq += 1
+        by_type = {}
+        for i, entity_id in enumerate(entity_ids):
+            if entity_id in self._written_ids:
+                self.duplicates += 1
+                continue
+            self._written_ids.add(entity_id)
+            by_type.setdefault(metadata[i]["entity_type"], []).append(i)
+
+        for entity_type, idxs in by_type.items():
+            columns = NODE_COLUMNS + _class_columns(
+                ENTITY_CLASSES[entity_type], ["id"])
+            rows = {"entity_id": [entity_ids[i] for i in idxs],
+                    "id": [entity_ids[i] for i in idxs],
+                    "text": [texts[i] for i in idxs],
+                    "embedding": [np.asarray(embeddings[i], dtype=np.float32)
+                                  .tolist() for i in idxs],
+                    "batch_seq": [self.batch_seq] * len(idxs)}
+            for column, _ in columns[len(NODE_COLUMNS):]:
+                rows[column] = [metadata[i].get(column) for i in idxs]
+            self._write(f"nodes_{entity_type}", columns, rows)
+            self.nodes += len(idxs)
+
+    def write_relationships(self, relationships: pd.DataFrame,
+                            relationship_type: str):
+        """Write relationships with source and terminal node id columns"""
+        if relationships.shape[0] == 0:
+            return
+        relationship_cls = RELATIONSHIP_CLASSES[relationship_type.lower()]
+        columns = [("source", "START_ID(Entity)"),
+                   ("terminal", "END_ID(Entity)"), ("rel_id", "string")] + \
+            [column for column in _class_columns(relationship_cls, []) if
+             column[0] in relationships.columns]
+        rows = {column: [None if pd.isna(value) else value for value in
+                         relationships[column]] for column, _ in columns}
+        self._write(f"relationships_{relationship_type}", columns, rows)
+        self.relationships += relationships.shape[0]
+
+    def close(self):
+        """Finish the files and write the header files and the watermark"""
+        for writer in self._writers.values():
+            if self.file_format == "parquet":
+                writer.close()
+        for ofile in self._files.values():
+            ofile.close()
+        self._write("ingest_state", [("name", "string"),
+                                     ("batch_seq", "long")],
+                    {"name": ["watermark"], "batch_seq": [self.batch_seq]})
+        if self.file_format == "parquet":
+            self._writers["ingest_state"].close()
+        else:
+            self._files["ingest_state"].close()
+            for name in self._columns:
+                with open(self.output_dir / f"{name}_header.csv", "w",
+                          newline="") as ofile:
+                    csv.writer(ofile).writerow(self._header(name))
+
+    def _files_arg(self, name: str) -> str:
+        if self.file_format == "csv":
+            return f"{self.output_dir / (name + '_header.csv')},"\
+                f"{self._path(name)}"
+        return str(self._path(name))
+
+    def import_command(self, database: str = "neo4j") -> str:
+        """neo4j-admin command importing the written files into an empty
+        database"""
+        args = ["neo4j-admin database import full", database,
+                "--multiline-fields=true",
+                f"--array-delimiter='{self.array_delimiter}'",
+                "--skip-duplicate-nodes=true"]
+        if self.file_format == "parquet":
+            args.append("--input-type=parquet")
+        for name in self._columns:
+            if name.startswith("nodes_"):
+                label = entity_label(name[len("nodes_"):])
+                args.append(f"--nodes=Entity:{label}={self._files_arg(name)}")
+            elif name.startswith("relationships_"):
+                relationship_type = name[len("relationships_"):]
+                args.append(f"--relationships={relationship_type}="
+                            f"{self._files_arg(name)}")
+        args.append(f"--nodes=IngestState={self._files_arg('ingest_state')}")
+        return " ".join(args)
+
+    def __str__(self):
+        return f"Bulk export: {self.nodes} nodes, {self.relationships} "\
+            f"relationships in {self.batch_seq} batches, {self.duplicates} "\
+            f"duplicate nodes skipped, written to {self.output_dir}"
@@ -0,0 +1,58 @@
+from typing import Dict, Hashable, Iterable, List, Tuple
+
+
+class UnionFind:
+
+    def __init__(self):
+        """Disjoint sets over arbitrary hashable items with path halving and
+        union by size"""
+        self._parent = {}
+        self._size = {}
+
+    def find(self, item: Hashable) -> Hashable:
+        if item not in self._parent:
+            self._parent[item] = item
+            self._size[item] = 1
+            return item
+        while self._parent[item] != item:
+            self._parent[item] = self._parent[self._parent[item]]
+            item = self._parent[item]
+        return item
+
+    def union(self, a: Hashable, b: Hashable):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] += self._size[b]
+
+    def components(self) -> List[List[Hashable]]:
+        """Every set with more than one member"""
+        groups = {}
+        for item in self._parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return [members for members in groups.values() if len(members) > 1]
+
+
+def collapse_plan(edges: Iterable[Tuple[Hashable, Hashable]],
+                  sort_keys: Dict[Hashable, tuple]
+                  ) -> List[Tuple[Hashable, List[Hashable]]]:
+    """Group nodes joined by edges into connected components and pick the
+    node each component is merged into
+    Args:
+        edges: Pairs of nodes that refer to the same entity
+        sort_keys: Sort key of each node. The node with the smallest key is
+            kept, so the result doesn't depend on edge order
+    Returns:
+        List of the kept node and the nodes merged into it, one per component
+    """
+    union_find = UnionFind()
+    for a, b in edges:
+        union_find.union(a, b)
+    plan = []
+    for members in union_find.components():
+        members = sorted(members, key=lambda node: sort_keys[node])
+        plan.append((members[0], members[1:]))
+    return sorted(plan, key=lambda merge: sort_keys[merge[0]])
@@ -0,0 +1,94 @@
+from data_structures.key import TableDataKey
+from embedding import EntityEmbedder
+from onnx_embedding import OnnxEncoder
+
+from typing import List
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def _pair_scores(vecs: np.ndarray) -> np.ndarray:
+    """Cosine similarity of every pair of unit vectors"""
+    scores = vecs @ vecs.T
+    return scores[np.triu_indices(len(vecs), k=1)]
+
+
+def compare(texts: List[str], reference: EntityEmbedder,
+            candidate: EntityEmbedder, threshold: float = 0.96,
+            name_dim: int = 768):
+    """Print how closely the candidate embedder agrees with the reference on
+    texts, both per vector and on which pairs would get identity edges
+    Args:
+        texts: Entity texts to embed
+        reference: Full precision embedder
+        candidate: Embedder being evaluated
+        threshold: Score above which identity edges are created
+        name_dim: Size of the name part of the concatenated embedding
+    """
+    t = time.perf_counter()
+    ref_vecs = np.array(reference.embed_documents(texts))
+    ref_time = time.perf_counter() - t
+    t = time.perf_counter()
+    cand_vecs = np.array(candidate.embed_documents(texts))
+    cand_time = time.perf_counter() - t
+
+    agreement = np.sum(ref_vecs * cand_vecs, axis=-1)
+    ref_name = ref_vecs[:, :name_dim] / \
+        np.linalg.norm(ref_vecs[:, :name_dim], axis=-1, keepdims=True)
+    cand_name = cand_vecs[:, :name_dim] / \
+        np.linalg.norm(cand_vecs[:, :name_dim], axis=-1, keepdims=True)
+    name_agreement = np.sum(ref_name * cand_name, axis=-1)
+
+    print(f"{len(texts)} texts, reference {ref_time:.1f}s, candidate "
+          f"{cand_time:.1f}s ({ref_time / cand_time:.2f}x speedup)")
+    for label, values in [("Cosine agreement", agreement),
+                          ("Name cosine agreement", name_agreement)]:
+        percentiles = np.percentile(values, [0, 1, 5, 50])
+        print(f"{label}: mean {values.mean():.5f}, min {percentiles[0]:.5f}, "
+              f"p1 {percentiles[1]:.5f}, p5 {percentiles[2]:.5f}, median "
+              f"{percentiles[3]:.5f}")
+
+    ref_scores = _pair_scores(ref_vecs)
+    cand_scores = _pair_scores(cand_vecs)
+    ref_pairs = ref_scores > threshold
+    cand_pairs = cand_scores > threshold
+    both = np.sum(ref_pairs & cand_pairs)
+    print(f"Pairs above {threshold}: reference {ref_pairs.sum()}, candidate "
+          f"{cand_pairs.sum()}, both {both}")
+    if ref_pairs.sum():
+        print(f"Identity pair recall: {both / ref_pairs.sum():.4f}")
+    if cand_pairs.sum():
+        print(f"Identity pair precision: {both / cand_pairs.sum():.4f}")
+    print("Max pair score difference: "
+          f"{np.abs(ref_scores - cand_scores).max():.5f}")
+
+
+parser = argparse.ArgumentParser(
+    description="Measure agreement between the full precision entity "
+    "embedder and the quantized ONNX one on a table's entity texts")
+parser.add_argument("--table-key", type=str, help="Path to table key json")
+parser.add_argument("--csv-file", type=str,
+                    help="csv file to sample rows from")
+parser.add_argument("--model-dir", type=str,
+                    help="Directory of the exported ONNX model")
+parser.add_argument("--sample-size", type=int, default=2000)
+parser.add_argument("--threshold", type=float, default=0.96,
+                    help="Score above which identity edges are created")
+parser.add_argument("--full-precision", action="store_true",
+                    help="Compare the unquantized ONNX model instead")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    table_key = TableDataKey(args.table_key)
+    df = pd.read_csv(args.csv_file).replace({np.nan: None})
+    df = df.sample(min(args.sample_size, df.shape[0]), random_state=0)
+    texts = table_key.build_frame(df).entity_texts
+
+    reference = EntityEmbedder()
+    candidate = EntityEmbedder(
+        model_name=reference.model_name,
+        encoder=OnnxEncoder(args.model_dir,
+                            quantized=not args.full_precision))
+    compare(texts, reference, candidate, threshold=args.threshold)
@@ -144,7 +144,7 @@ class Neo4jConversation(ConversationOpenAI):
         query = self._extract_query(response)
         if query is not None:
             try:
-                res = self.db_conn.query(query)
+                res = self.db_conn.query(query, routing="r")
                 return query, res, None
             except Exception as e:
                 return query, None, e
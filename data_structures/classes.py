@@ -1,9 +1,43 @@
 from functools import cached_property
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field, fields, asdict
 from typing import Optional, Dict, List
 
 from data_structures.utils import get_name_parts
 
+import pandas as pd
+
+
+def _as_str(col: pd.Series) -> pd.Series:
+    """Column-wise equivalent of formatting each value into an f-string"""
+    return col.astype(str).where(col.notna(), "None")
+
+
+def _join_field_strs(frame: pd.DataFrame, names: List[str]) -> pd.Series:
+    """Column-wise equivalent of ", ".join(f"{field} of {value}") over the
+    non-null values of the given fields"""
+    joined = pd.Series("", index=frame.index, dtype=object)
+    for name in names:
+        if name not in frame:
+            continue
+        col = frame[name]
+        piece = f"{name} of " + _as_str(col)
+        sep = joined.where(joined == "", joined + ", ")
+        joined = joined.mask(col.notna(), sep + piece)
+    return joined
+
+
+# Fields that don't say anything about which real world entity is meant
+_KEY_EXCLUDED_FIELDS = ["entity_type", "row_index", "id"]
+
+
+def entity_key(entity_dict: dict) -> str:
+    """Normalized key identifying exact duplicate entities: the entity type
+    and every non-null descriptive field"""
+    parts = [str(entity_dict["entity_type"])]
+    parts += [f"{field}\x1e{value}" for field, value in entity_dict.items()
+              if field not in _KEY_EXCLUDED_FIELDS and value is not None]
+    return "\x1f".join(parts)
+
 
 @dataclass(kw_only=True)
 @dataclass
@@ -26,6 +60,28 @@ class Entity:
             data_str += ", ".join(field_strs)
         return data_str
 
+    @classmethod
+    def frame_to_text(cls, frame: pd.DataFrame) -> pd.Series:
+        """Vectorized `to_text` over a frame with one column per field"""
+        entity_type = _as_str(frame["entity_type"])
+        data_str = entity_type + " named " + _as_str(frame["name"]) + ";"
+        data_str += " This " + entity_type + " has "
+        names = [f.name for f in fields(cls) if f.name not in ["entity_type",
+                                                                 "name"]]
+        return data_str + _join_field_strs(frame, names)
+
+    @classmethod
+    def frame_to_key(cls, frame: pd.DataFrame) -> pd.Series:
+        """Vectorized `entity_key` over a frame with one column per field"""
+        keys = _as_str(frame["entity_type"])
+        for name in [f.name for f in fields(cls)]:
+            if name in _KEY_EXCLUDED_FIELDS or name not in frame:
+                continue
+            col = frame[name]
+            keys = keys.mask(col.notna(),
+                             keys + f"\x1f{name}\x1e" + _as_str(col))
+        return keys
+
 @dataclass(kw_only=True)
 class Individual(Entity):
     entity_type = "Individual"
@@ -72,6 +128,26 @@ class Individual(Entity):
             data_str += ", ".join(field_strs)
         return data_str
 
+    @classmethod
+    def frame_to_text(cls, frame: pd.DataFrame) -> pd.Series:
+        """Vectorized `to_text` over a frame with one column per field"""
+        data_str = "An individual named " + _as_str(frame["name"]) + \
+            " with first name of " + _as_str(frame["first_name"])
+        for key, label in [("last_name", "last name"),
+                           ("middle_name", "middle name"),
+                           ("title", "title"), ("suffix", "suffix")]:
+            col = frame[key]
+            data_str = data_str.mask(col.notna(),
+                                     data_str + f", {label} of " + _as_str(col))
+        data_str += ";"
+
+        names = [f.name for f in fields(cls) if f.name not in
+                 ["name", "first_name", "last_name", "middle_name", "suffix",
+                  "title", "entity_type", "row_index"]]
+        field_strs = _join_field_strs(frame, names)
+        return data_str.mask(field_strs != "",
+                             data_str + " This individual has " + field_strs)
+
 
 @dataclass
 class Corporation(Entity):
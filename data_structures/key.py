@@ -1,14 +1,66 @@
-from typing import List, Tuple, Optional, Union
+from typing import List, Tuple, Optional, Union, Dict
+from dataclasses import dataclass, field, fields, asdict
+from collections import Counter
 
 from data_structures.classes import (
     Entity, Relationship, Corporation, Agency,
-    Violation, Individual, Contribution, PAC, Organization
+    Violation, Individual, Contribution, PAC, Organization, entity_key
 )
 
 import json
+import numpy as np
 import pandas as pd
 
 
+ENTITY_CLASSES = {"individual": Individual, "organization": Organization,
+                  "corporation": Corporation, "agency": Agency, "pac": PAC}
+RELATIONSHIP_CLASSES = {"violation": Violation, "contribution": Contribution}
+
+
+@dataclass
+class KeyBatch:
+    """Entities and relationships extracted from a batch of rows
+    Attributes:
+        entity_texts: Text description of each entity, used for embedding
+        entities_metadata: Node properties of each entity
+        relationships: One row of relationship properties per relationship
+        src_entity_idxs: Index into the entity lists of each relationship's
+            source entity
+        term_entity_idxs: Index into the entity lists of each relationship's
+            terminal entity
+        rejected: Rows dropped because the type of one of their entities
+            could not be resolved
+        reject_counts: Number of rejected rows per entity position in the key
+        entity_keys: Normalized key of each entity, equal for exact
+            duplicates
+    """
+    entity_texts: List[str]
+    entities_metadata: List[dict]
+    relationships: pd.DataFrame
+    src_entity_idxs: np.ndarray
+    term_entity_idxs: np.ndarray
+    entity_keys: List[str]
+    rejected: pd.DataFrame = field(default_factory=pd.DataFrame)
+    reject_counts: Dict[int, int] = field(default_factory=dict)
+
+    def __len__(self):
+        return len(self.entity_texts)
+
+
+def _lower(col: pd.Series) -> pd.Series:
+    """Lowercase the string values of a column, leaving other values as is"""
+    if col.dtype != object:
+        return col
+    lowered = col.str.lower()
+    return lowered.where(lowered.notna(), col)
+
+
+def _to_records(frame: pd.DataFrame) -> List[dict]:
+    """Convert frame to a list of dicts with nulls as None"""
+    frame = frame.astype(object)
+    return frame.where(frame.notna(), None).to_dict("records")
+
+
 class TableDataKey:
     def __init__(self, json_file):
         """Class to handle the extraction of entities and relationships from a
@@ -24,9 +76,71 @@ class TableDataKey:
         self.relationship_type = self.key_dict["relationship_type"]
         entity_types = []
         for entity in self.key_dict["entities"]:
-            for entity_type in entity["entity_type"]:
-                entity_types.append(entity_type["type"])
+            if isinstance(entity["entity_type"], str):
+                entity_types.append(entity["entity_type"])
+            else:
+                for entity_type in entity["entity_type"]:
+                    entity_types.append(entity_type["type"])
         self.entity_types = set(entity_types)
+        self.reject_counts = Counter()
+        self._compile()
+        # Columns rows are sorted by so they're fetched in the same order
+        # every time. Defaults to every column the key reads
+        self.order_by = self.key_dict.get("order_by") or self.columns
+        # Columns identifying a row across reloads, if the table has any
+        self.row_key = self.key_dict.get("row_key")
+
+    def _compile(self):
+        """Resolve the key into the column selections and entity type
+        conditions used by `build_frame`"""
+        self._entity_columns = []
+        self._entity_type_options = []
+        for entity_dict in self.key_dict["entities"]:
+            entity_type = entity_dict["entity_type"]
+            if isinstance(entity_type, str):
+                self._entity_type_options.append(entity_type)
+            else:
+                self._entity_type_options.append(
+                    [(option["column"], option["value"], option["type"]) for
+                     option in entity_type])
+            columns = {}
+            for entity_type, fields_map in entity_dict["fields"].items():
+                entity_cls = ENTITY_CLASSES[entity_type]
+                class_fields = {f.name for f in fields(entity_cls)}
+                unknown = set(fields_map) - class_fields
+                if len(unknown):
+                    raise ValueError(f"Fields {sorted(unknown)} are not defined"
+                                     f" for entity type {entity_type}")
+                columns[entity_type] = (list(fields_map.keys()),
+                                        list(fields_map.values()))
+            self._entity_columns.append(columns)
+
+        self._relationship_columns = []
+        for relationship_dict in self.key_dict["relationships"]:
+            fields_map = relationship_dict["fields"]
+            relationship_type = relationship_dict["relationship_type"]
+            relationship_cls = RELATIONSHIP_CLASSES[relationship_type]
+            unknown = set(fields_map) - {f.name for f in
+                                         fields(relationship_cls)}
+            if len(unknown):
+                raise ValueError(f"Fields {sorted(unknown)} are not defined"
+                                 f" for relationship type {relationship_type}")
+            self._relationship_columns.append((list(fields_map.keys()),
+                                               list(fields_map.values())))
+
+    @property
+    def columns(self) -> List[str]:
+        """Every column the key reads, in the order they appear in the key"""
+        columns = []
+        for options, entity_columns in zip(self._entity_type_options,
+                                           self._entity_columns):
+            if not isinstance(options, str):
+                columns += [column for column, _, _ in options]
+            for _, cols in entity_columns.values():
+                columns += cols
+        for _, cols in self._relationship_columns:
+            columns += cols
+        return list(dict.fromkeys(columns))
 
     def _load_query(self):
         query = self.key_dict.get("query")
@@ -42,6 +156,146 @@ class TableDataKey:
         relationships, entity_mapping = self.build_relationships(row, row_index)
         return entities, relationships, entity_mapping
 
+    def build_frame(self, df: pd.DataFrame, row_index: bool = True) -> KeyBatch:
+        """Extract the entities and relationships of every row of df at once.
+        Entities are ordered by their position in the key, then by row, so
+        with `n` rows entity `i` of row `j` is at `i * n + j`. Rows whose
+        entity type can't be resolved are dropped and returned in
+        `KeyBatch.rejected`
+        Args:
+            df: Rows to extract from
+            row_index: Whether to set each entity and relationship's row_index
+                to the row's index label
+        """
+        entity_types = self._get_entity_types(df)
+        df, entity_types, rejected, reject_counts = self._reject_unresolved(
+            df, entity_types)
+        num_rows = df.shape[0]
+
+        entity_texts = np.empty(num_rows * len(entity_types), dtype=object)
+        entities_metadata = np.empty(num_rows * len(entity_types),
+                                     dtype=object)
+        entity_keys = np.empty(num_rows * len(entity_types), dtype=object)
+        for slot, (columns, types) in enumerate(zip(self._entity_columns,
+                                                    entity_types)):
+            for entity_type, (names, cols) in columns.items():
+                mask = (types == entity_type).to_numpy()
+                if not mask.any():
+                    continue
+                entity_cls = ENTITY_CLASSES[entity_type]
+                frame = pd.DataFrame({name: _lower(df[col][mask]) for name, col
+                                      in zip(names, cols)},
+                                     index=df.index[mask])
+                frame["entity_type"] = entity_type
+                if row_index:
+                    frame["row_index"] = frame.index
+                frame = frame.reindex(columns=[f.name for f in
+                                               fields(entity_cls)])
+                positions = slot * num_rows + np.flatnonzero(mask)
+                entity_texts[positions] = \
+                    entity_cls.frame_to_text(frame).to_numpy()
+                entities_metadata[positions] = _to_records(frame)
+                entity_keys[positions] = \
+                    entity_cls.frame_to_key(frame).to_numpy()
+
+        relationships = []
+        src_entity_idxs = []
+        term_entity_idxs = []
+        rows = np.arange(num_rows)
+        for relationship_dict, (names, cols) in \
+                zip(self.key_dict["relationships"], self._relationship_columns):
+            relationship_type = relationship_dict["relationship_type"]
+            relationship_cls = RELATIONSHIP_CLASSES[relationship_type]
+            frame = pd.DataFrame({name: df[col] for name, col in zip(names,
+                                                                     cols)},
+                                 index=df.index)
+            frame["relationship_type"] = relationship_type
+            if row_index:
+                frame["row_index"] = frame.index
+            relationships.append(frame.reindex(
+                columns=[f.name for f in fields(relationship_cls)]))
+            src_entity_idxs.append(relationship_dict["source_entity"] *
+                                   num_rows + rows)
+            term_entity_idxs.append(relationship_dict["terminal_entity"] *
+                                    num_rows + rows)
+
+        if len(relationships):
+            relationships = pd.concat(relationships, ignore_index=True)
+            relationships = pd.DataFrame(_to_records(relationships),
+                                         columns=relationships.columns)
+            src_entity_idxs = np.concatenate(src_entity_idxs)
+            term_entity_idxs = np.concatenate(term_entity_idxs)
+        else:
+            relationships = pd.DataFrame()
+            src_entity_idxs = np.array([], dtype=np.int64)
+            term_entity_idxs = np.array([], dtype=np.int64)
+
+        return KeyBatch(list(entity_texts), list(entities_metadata),
+                        relationships, src_entity_idxs, term_entity_idxs,
+                        list(entity_keys), rejected, reject_counts)
+
+    def build_rows(self, df: pd.DataFrame) -> KeyBatch:
+        """Row by row equivalent of `build_frame`. Much slower, kept as a
+        fallback for keys `build_frame` can't handle"""
+        df, _, rejected, reject_counts = self._reject_unresolved(
+            df, self._get_entity_types(df))
+        entity_texts = []
+        entities_metadata = []
+        src_entity_idxs = []
+        term_entity_idxs = []
+        relationships = []
+        for idx, row in df.iterrows():
+            entities, row_relationships, entity_relationship_idx = \
+                self.build(row, idx)
+            num_entities = len(entity_texts)
+            src_entity_idxs += [rel[0]+num_entities for rel
+                                in entity_relationship_idx]
+            term_entity_idxs += [rel[1]+num_entities for rel
+                                 in entity_relationship_idx]
+            entity_texts += list(map(lambda x: x.to_text(), entities))
+            entities_metadata += list(map(asdict, entities))
+            relationships += row_relationships
+        return KeyBatch(entity_texts, entities_metadata,
+                        pd.DataFrame([asdict(rel) for rel in relationships]),
+                        np.array(src_entity_idxs, dtype=np.int64),
+                        np.array(term_entity_idxs, dtype=np.int64),
+                        list(map(entity_key, entities_metadata)), rejected,
+                        reject_counts)
+
+    def _reject_unresolved(self, df: pd.DataFrame,
+                           entity_types: List[pd.Series]) -> tuple:
+        """Drop the rows of df where the type of any entity couldn't be
+        resolved, counting them in `reject_counts`. Returns the kept rows,
+        their entity types, the rejected rows and the batch's reject counts"""
+        resolved = [types.notna().to_numpy() for types in entity_types]
+        keep = np.all(resolved, axis=0) if len(resolved) else \
+            np.ones(df.shape[0], bool)
+        rejected = df[~keep]
+        reject_counts = {slot: int((~mask).sum()) for slot, mask in
+                         enumerate(resolved) if not mask.all()}
+        self.reject_counts.update(reject_counts)
+        if not keep.all():
+            df = df[keep]
+            entity_types = [types[keep] for types in entity_types]
+        return df, entity_types, rejected, reject_counts
+
+    def _get_entity_types(self, df: pd.DataFrame) -> List[pd.Series]:
+        """Entity type of each row for each entity in the key, None where no
+        option matches. As in `_get_entity_type` the first matching option
+        wins"""
+        entity_types = []
+        for options in self._entity_type_options:
+            if isinstance(options, str):
+                types = pd.Series(options, index=df.index, dtype=object)
+            else:
+                conditions = [(df[column] == value).to_numpy() for column,
+                              value, _ in options]
+                choices = [entity_type for _, _, entity_type in options]
+                types = pd.Series(np.select(conditions, choices, None),
+                                  index=df.index, dtype=object)
+            entity_types.append(types)
+        return entity_types
+
     def _get_entity_type(self, entity_type: Union[dict, str], row):
         if isinstance(entity_type, str):
             return entity_type
@@ -55,8 +309,6 @@ class TableDataKey:
         entities = []
         for entity_dict in self.key_dict["entities"]:
             entity_type = self._get_entity_type(entity_dict["entity_type"], row)
-            if entity_type is None:
-                print(row)
             fields_map = entity_dict["fields"][entity_type]
             vals = dict(zip(fields_map.keys(),
                             list(map(lambda x: x.lower() if isinstance(x, str)
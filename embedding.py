@@ -1,4 +1,4 @@
-from typing import List, Tuple
+from typing import List, Tuple, Any
 from langchain_community.embeddings import HuggingFaceEmbeddings
 import re
 import numpy as np
@@ -6,6 +6,20 @@ import numpy as np
 
 class EntityEmbedder(HuggingFaceEmbeddings):
 
+    cache: Any = None
+    """Optional EmbeddingCache the name and description passes look up
+    before running the model"""
+    encoder: Any = None
+    """Optional backend with an `encode(texts)` method to run the model
+    with, such as an EmbeddingWorkerPool. Defaults to the in process model"""
+
+    def __init__(self, **kwargs: Any):
+        """Loads the in process model unless an encoder is given to run it"""
+        if kwargs.get("encoder") is None:
+            super().__init__(**kwargs)
+        else:
+            super(HuggingFaceEmbeddings, self).__init__(**kwargs)
+
     @staticmethod
     def _split_name_and_desc(doc: str) -> Tuple[str, str]:
         """Split doc into a piece giving the name of the entity and a piece
@@ -25,8 +39,14 @@ class EntityEmbedder(HuggingFaceEmbeddings):
             name_docs, desc_docs = zip(*[self._split_name_and_desc(doc) for doc in
                                          docs])
 
-            name_vecs = np.array(super().embed_documents(name_docs))
-            desc_vecs = np.array(super().embed_documents(desc_docs))
+            # Only encode each distinct string once, names and descriptions
+            # share a single pass since they are often identical
+            positions = {}
+            inverse = [positions.setdefault(doc, len(positions)) for doc in
+                       name_docs + desc_docs]
+            unique_vecs = self._encode(list(positions))
+            name_vecs = unique_vecs[inverse[:len(docs)]]
+            desc_vecs = unique_vecs[inverse[len(docs):]]
 
             vecs = np.concatenate([name_weight * name_vecs,
                                    desc_weight * desc_vecs], axis=-1)
@@ -35,3 +55,26 @@ class EntityEmbedder(HuggingFaceEmbeddings):
         else:
             return []
 
+    def embed_query(self, text: str) -> List[float]:
+        """Embeds text the same way as `embed_documents`, so queries come
+        from the same backend as, and are comparable with, the stored
+        embeddings"""
+        return list(self.embed_documents([text])[0])
+
+    def _encode(self, texts: List[str]) -> np.array:
+        """Embed texts with the underlying model, going through the cache if
+        one is set"""
+        if self.cache is None:
+            return self._encode_uncached(texts)
+        # Encoders that don't reproduce the model's vectors, like the int8
+        # ONNX one, keep their vectors apart under their own cache name
+        model_name = getattr(self.encoder, "cache_name", self.model_name)
+        return np.asarray(self.cache.embed(texts, model_name,
+                                           self._encode_uncached),
+                          dtype=np.float64)
+
+    def _encode_uncached(self, texts: List[str]) -> np.array:
+        if self.encoder is not None:
+            return np.asarray(self.encoder.encode(texts), dtype=np.float64)
+        return np.array(super().embed_documents(texts))
+
@@ -0,0 +1,212 @@
+from typing import Callable, List, Optional
+from collections import OrderedDict
+from pathlib import Path
+
+import hashlib
+import pickle
+import threading
+import numpy as np
+
+
+class EmbeddingCache:
+
+    def __init__(self, cache_dir: str, capacity: int = 1_000_000,
+                 flush_every: int = 50):
+        """Disk backed, content addressed cache of text embeddings. Vectors
+        are kept in a memory mapped array and looked up by a hash of the
+        model name and the normalized text. Once full, the least recently
+        used vector is evicted
+        Args:
+            cache_dir: Directory holding the vector and index files
+            capacity: Max number of vectors kept in the cache
+            flush_every: Write the index to disk after this many calls to
+                `embed` that added vectors
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.capacity = capacity
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._unflushed = 0
+        self._vectors = None
+
+        # Maps key -> slot in self._vectors, least recently used first. The
+        # key held by each slot is also stored next to the vectors so an
+        # index written before the slot was reused can't return the wrong
+        # vector
+        self._index = OrderedDict()
+        self._slot_keys = None
+        self._free = []
+        if self._index_file.exists() and self._vector_file.exists() and \
+                self._keys_file.exists():
+            with open(self._index_file, "rb") as ifile:
+                state = pickle.load(ifile)
+            self._index = state["index"]
+            self._vectors = np.lib.format.open_memmap(self._vector_file,
+                                                      mode="r+")
+            self._slot_keys = np.lib.format.open_memmap(self._keys_file,
+                                                        mode="r+")
+            if self._vectors.shape[0] != capacity:
+                self._resize(capacity)
+            used = set(self._index.values())
+            self._free = [slot for slot in range(self.capacity - 1, -1, -1)
+                          if slot not in used]
+
+    @property
+    def _index_file(self) -> Path:
+        return self.cache_dir / "index.pkl"
+
+    @property
+    def _vector_file(self) -> Path:
+        return self.cache_dir / "vectors.npy"
+
+    @property
+    def _keys_file(self) -> Path:
+        return self.cache_dir / "keys.npy"
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalize text the same way the embedding model sees it"""
+        return text.replace("\n", " ")
+
+    @classmethod
+    def key(cls, text: str, model_name: str) -> bytes:
+        # Hex rather than raw digest since numpy strips trailing null bytes
+        return hashlib.sha1(f"{model_name}\0{cls.normalize(text)}"
+                            .encode("utf-8")).hexdigest().encode("ascii")
+
+    def _resize(self, capacity: int):
+        """Change the number of slots, dropping the least recently used
+        vectors if shrinking"""
+        while len(self._index) > capacity:
+            self._index.popitem(last=False)
+            self.evictions += 1
+        old_vectors = self._vectors
+        old_keys = self._slot_keys
+        self._vectors = None
+        self._slot_keys = None
+        vector_file = self.cache_dir / "vectors.resize.npy"
+        keys_file = self.cache_dir / "keys.resize.npy"
+        vectors = np.lib.format.open_memmap(vector_file, mode="w+",
+                                            dtype=np.float32,
+                                            shape=(capacity,
+                                                   old_vectors.shape[1]))
+        slot_keys = np.lib.format.open_memmap(keys_file, mode="w+",
+                                              dtype="S40", shape=(capacity,))
+        for new_slot, (key, old_slot) in enumerate(list(self._index.items())):
+            if old_keys[old_slot] != key:
+                del self._index[key]
+                continue
+            vectors[new_slot] = old_vectors[old_slot]
+            slot_keys[new_slot] = key
+            self._index[key] = new_slot
+        vectors.flush()
+        slot_keys.flush()
+        del old_vectors, old_keys, vectors, slot_keys
+        vector_file.replace(self._vector_file)
+        keys_file.replace(self._keys_file)
+        self._vectors = np.lib.format.open_memmap(self._vector_file,
+                                                  mode="r+")
+        self._slot_keys = np.lib.format.open_memmap(self._keys_file,
+                                                    mode="r+")
+        self._flush()
+
+    def _allocate(self, dim: int):
+        self._vectors = np.lib.format.open_memmap(self._vector_file,
+                                                  mode="w+",
+                                                  dtype=np.float32,
+                                                  shape=(self.capacity, dim))
+        self._slot_keys = np.lib.format.open_memmap(self._keys_file,
+                                                    mode="w+", dtype="S40",
+                                                    shape=(self.capacity,))
+        self._free = list(range(self.capacity - 1, -1, -1))
+
+    def _take_slot(self) -> int:
+        if len(self._free):
+            return self._free.pop()
+        _, slot = self._index.popitem(last=False)
+        self.evictions += 1
+        return slot
+
+    def embed(self, texts: List[str], model_name: str,
+              encode: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Embed texts, only calling encode on the texts not in the cache
+        Args:
+            texts: Texts to embed
+            model_name: Name of the model encode uses
+            encode: Function embedding a list of texts with the model
+        """
+        keys = [self.key(text, model_name) for text in texts]
+        with self._lock:
+            vectors = [None] * len(texts)
+            missing = []
+            for i, key in enumerate(keys):
+                slot = self._index.get(key)
+                if slot is not None and self._slot_keys[slot] != key:
+                    del self._index[key]
+                    slot = None
+                if slot is None:
+                    missing.append(i)
+                else:
+                    self._index.move_to_end(key)
+                    vectors[i] = np.array(self._vectors[slot])
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        if len(missing):
+            new_vectors = np.asarray(encode([texts[i] for i in missing]),
+                                     dtype=np.float32)
+            with self._lock:
+                if self._vectors is None:
+                    self._allocate(new_vectors.shape[1])
+                # A batch bigger than the cache only keeps its last vectors
+                for i, vector in zip(missing[-self.capacity:],
+                                     new_vectors[-self.capacity:]):
+                    if keys[i] not in self._index:
+                        self._index[keys[i]] = self._take_slot()
+                    slot = self._index[keys[i]]
+                    self._vectors[slot] = vector
+                    self._slot_keys[slot] = keys[i]
+                for i, vector in zip(missing, new_vectors):
+                    vectors[i] = vector
+                self._unflushed += 1
+                if self._unflushed >= self.flush_every:
+                    self._flush()
+
+        if len(vectors) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack(vectors)
+
+    def _flush(self):
+        if self._vectors is None:
+            return
+        self._vectors.flush()
+        self._slot_keys.flush()
+        tmp_file = self.cache_dir / "index.pkl.tmp"
+        with open(tmp_file, "wb") as ofile:
+            pickle.dump({"index": self._index}, ofile)
+        tmp_file.replace(self._index_file)
+        self._unflushed = 0
+
+    def flush(self):
+        """Write the cache index and vectors to disk"""
+        with self._lock:
+            self._flush()
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __str__(self):
+        hit_rate = self.hit_rate
+        hit_rate = "n/a" if hit_rate is None else f"{100 * hit_rate:.1f}%"
+        return f"Embedding cache: {self.hits} hits, {self.misses} misses "\
+            f"({hit_rate} hit rate), {self.evictions} evictions, "\
+            f"{len(self)}/{self.capacity} vectors"
@@ -0,0 +1,106 @@
+from typing import Any, Dict, List, Optional
+from collections import defaultdict
+
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+
+
+_model = None
+_encode_kwargs = {}
+
+
+def _init_worker(model_name: str, cache_folder: Optional[str],
+                 model_kwargs: Dict[str, Any], encode_kwargs: Dict[str, Any],
+                 num_threads: int):
+    global _model, _encode_kwargs
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(num_threads)
+    _model = SentenceTransformer(model_name, cache_folder=cache_folder,
+                                 **model_kwargs)
+    _encode_kwargs = encode_kwargs
+
+
+def _encode_chunk(chunk):
+    chunk_id, texts = chunk
+    t = time.perf_counter()
+    vecs = _model.encode(texts, batch_size=len(texts), **_encode_kwargs)
+    return chunk_id, os.getpid(), np.asarray(vecs, dtype=np.float32), \
+        time.perf_counter() - t
+
+
+class EmbeddingWorkerPool:
+
+    def __init__(self, model_name: str, num_workers: Optional[int] = None,
+                 batch_size: int = 64, threads_per_worker: Optional[int] =
+                 None, cache_folder: Optional[str] = None, model_kwargs:
+                 Optional[Dict[str, Any]] = None, encode_kwargs:
+                 Optional[Dict[str, Any]] = None):
+        """Pool of worker processes each holding their own copy of a
+        sentence transformer model. Texts are sorted by length and split into
+        batches of similar length to cut padding, batches are spread over the
+        workers and the vectors returned in input order
+        Args:
+            model_name: Name of the sentence transformer model
+            num_workers: Number of worker processes, defaults to the number of
+                cores
+            batch_size: Number of texts sent to a worker at a time
+            threads_per_worker: Number of torch threads in each worker,
+                defaults to splitting the cores evenly between workers
+            cache_folder: Path to store models
+            model_kwargs: Keyword arguments to pass to the model
+            encode_kwargs: Keyword arguments to pass to the model's `encode`
+        """
+        num_cores = os.cpu_count() or 1
+        self.num_workers = num_workers or num_cores
+        self.batch_size = batch_size
+        threads_per_worker = threads_per_worker or \
+            max(1, num_cores // self.num_workers)
+        encode_kwargs = dict(encode_kwargs or {})
+        encode_kwargs.pop("batch_size", None)
+        # Spawn so workers don't inherit torch state from the parent
+        self._pool = mp.get_context("spawn").Pool(
+            self.num_workers, initializer=_init_worker,
+            initargs=(model_name, cache_folder, model_kwargs or {},
+                      encode_kwargs, threads_per_worker))
+        self.worker_texts = defaultdict(int)
+        self.worker_seconds = defaultdict(float)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts across the workers, returning vectors in input order"""
+        texts = [text.replace("\n", " ") for text in texts]
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        chunks = [(i, [texts[j] for j in order[start:start+self.batch_size]])
+                  for i, start in enumerate(range(0, len(texts),
+                                                  self.batch_size))]
+
+        results = {}
+        for chunk_id, pid, vecs, seconds in \
+                self._pool.imap_unordered(_encode_chunk, chunks):
+            results[chunk_id] = vecs
+            self.worker_texts[pid] += vecs.shape[0]
+            self.worker_seconds[pid] += seconds
+
+        sorted_vecs = np.concatenate([results[i] for i in range(len(chunks))])
+        vecs = np.empty_like(sorted_vecs)
+        vecs[order] = sorted_vecs
+        return vecs
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __str__(self):
+        lines = [f"Embedding workers: {self.num_workers} processes, batch size"
+                 f" {self.batch_size}"]
+        for pid in sorted(self.worker_texts):
+            seconds = self.worker_seconds[pid]
+            rate = self.worker_texts[pid] / seconds if seconds > 0 else 0.
+            lines.append(f"  worker {pid}: {self.worker_texts[pid]} texts, "
+                         f"{seconds:.1f}s, {rate:.1f} texts/s")
+        return "\n".join(lines)
@@ -0,0 +1,121 @@
+from typing import Dict, Iterable, List
+from dataclasses import dataclass
+
+import threading
+import numpy as np
+
+
+@dataclass
+class DedupPlan:
+    """Which entities of a batch need new nodes
+    Attributes:
+        keys: Normalized key of each entity in the batch
+        rep: Index of the first entity in the batch with the same key as each
+            entity
+        known: Node id of entities whose key was already written this run,
+            by index of the first entity with that key
+        write_idxs: Indices of the entities that need new nodes
+    """
+    keys: List[str]
+    rep: np.ndarray
+    known: Dict[int, str]
+    write_idxs: np.ndarray
+
+
+class EntityDeduplicator:
+
+    def __init__(self):
+        """Collapses exact duplicate entities, both within a batch and against
+        the entities already written this run, so only one node is created
+        per normalized entity key"""
+        self._index = {}
+        # Node ids merged away by collapsing, to the id they were merged into
+        self._merged = {}
+        self._lock = threading.Lock()
+        self.entities = 0
+        self.batch_duplicates = 0
+        self.run_duplicates = 0
+
+    def plan(self, keys: List[str]) -> DedupPlan:
+        """Find the entities in a batch that need new nodes"""
+        first = {}
+        rep = np.array([first.setdefault(key, i) for i, key in
+                        enumerate(keys)], dtype=np.int64)
+        with self._lock:
+            known = {i: self._resolve(self._index[key]) for key, i in
+                     first.items() if key in self._index}
+        write_idxs = np.array([i for i in first.values() if i not in known],
+                              dtype=np.int64)
+        return DedupPlan(keys, rep, known, write_idxs)
+
+    def refresh(self, plan: DedupPlan) -> np.ndarray:
+        """Move entities written since the plan was made from the write set
+        to the known set, returning the indices that no longer need writing"""
+        with self._lock:
+            written = [i for i in plan.write_idxs if plan.keys[i] in
+                       self._index]
+            for i in written:
+                plan.known[i] = self._index[plan.keys[i]]
+            # Nodes may also have been merged since
+            for i, node_id in plan.known.items():
+                plan.known[i] = self._resolve(node_id)
+        if len(written):
+            plan.write_idxs = np.setdiff1d(plan.write_idxs, written)
+        return np.array(written, dtype=np.int64)
+
+    def _resolve(self, node_id: str) -> str:
+        """Id of the node that node_id ended up merged into"""
+        path = []
+        while node_id in self._merged:
+            path.append(node_id)
+            node_id = self._merged[node_id]
+        for merged_id in path[:-1]:
+            self._merged[merged_id] = node_id
+        return node_id
+
+    def remap(self, merged: Dict[str, str]):
+        """Point entities whose nodes were merged into another node at the
+        node they were merged into"""
+        with self._lock:
+            for merged_id, kept_id in merged.items():
+                kept_id = self._resolve(kept_id)
+                if kept_id != merged_id:
+                    self._merged[merged_id] = kept_id
+
+    def forget(self, plan: DedupPlan, missing_ids: Iterable[str]):
+        """Drop node ids that no longer exist, e.g. because they were deleted
+        outside the pipeline, moving their entities back to the write set"""
+        missing_ids = set(missing_ids)
+        missing = [i for i, node_id in plan.known.items() if node_id in
+                   missing_ids]
+        with self._lock:
+            for i in missing:
+                del plan.known[i]
+                self._index.pop(plan.keys[i], None)
+        plan.write_idxs = np.union1d(plan.write_idxs,
+                                     np.array(missing, dtype=np.int64))
+
+    def commit(self, plan: DedupPlan, written_ids: List[str]) -> np.ndarray:
+        """Record the node ids created for plan.write_idxs and return the node
+        id of every entity in the batch"""
+        ids = np.empty(len(plan.keys), dtype=object)
+        ids[plan.write_idxs] = written_ids
+        for i, node_id in plan.known.items():
+            ids[i] = node_id
+        with self._lock:
+            for i, node_id in zip(plan.write_idxs, written_ids):
+                self._index[plan.keys[i]] = node_id
+            self.entities += len(plan.keys)
+            self.batch_duplicates += int(np.sum(plan.rep !=
+                                                np.arange(len(plan.keys))))
+            self.run_duplicates += len(plan.known)
+        return ids[plan.rep]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __str__(self):
+        return f"Entity dedup: {self.entities} entities, "\
+            f"{self.batch_duplicates} duplicates within a batch, "\
+            f"{self.run_duplicates} duplicates of earlier batches, "\
+            f"{len(self)} distinct entities"
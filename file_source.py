@@ -0,0 +1,87 @@
+from typing import Iterator
+
+import re
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+
+def read_file_batches(path: str, row_index: int = 0,
+                      batch_size: int = 100_000,
+                      block_size: int = 16 << 20
+                      ) -> Iterator[pa.RecordBatch]:
+    """Stream a csv or Parquet file in Arrow record batches, so memory use
+    stays flat however big the file is. Files are memory mapped
+    Args:
+        path: csv or Parquet (.parquet, .pq) file
+        row_index: Number of rows at the start of the file to skip
+        batch_size: Max number of rows per chunk of a Parquet file
+        block_size: Number of bytes per chunk of a csv file
+    """
+    if path.endswith((".parquet", ".pq")):
+        return _parquet_batches(path, row_index, batch_size)
+    return _csv_batches(path, row_index, block_size)
+
+
+def _parquet_batches(path: str, row_index: int, batch_size: int
+                     ) -> Iterator[pa.RecordBatch]:
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    # Seek to the row group holding row_index, then skip the rest of the way
+    # within it
+    skip = row_index
+    start_group = 0
+    while start_group < parquet_file.num_row_groups and skip >= \
+            parquet_file.metadata.row_group(start_group).num_rows:
+        skip -= parquet_file.metadata.row_group(start_group).num_rows
+        start_group += 1
+    if start_group == parquet_file.num_row_groups:
+        return
+    for record_batch in parquet_file.iter_batches(
+            batch_size=batch_size,
+            row_groups=range(start_group, parquet_file.num_row_groups)):
+        if skip >= record_batch.num_rows:
+            skip -= record_batch.num_rows
+            continue
+        yield record_batch.slice(skip)
+        skip = 0
+
+
+def _csv_batches(path: str, row_index: int, block_size: int
+                 ) -> Iterator[pa.RecordBatch]:
+    column_types = None
+    rows_read = row_index
+    while True:
+        reader = _open_csv(path, rows_read, block_size, column_types)
+        # Types are inferred from the first block, keep them for the whole
+        # file. Dates are kept as the strings pd.read_csv would give
+        column_types = {field.name: pa.string() if
+                        pa.types.is_temporal(field.type) else field.type for
+                        field in reader.schema}
+        if any(pa.types.is_temporal(field.type) for field in reader.schema):
+            reader = _open_csv(path, rows_read, block_size, column_types)
+        try:
+            for record_batch in reader:
+                rows_read += record_batch.num_rows
+                yield record_batch
+            return
+        except pa.ArrowInvalid as error:
+            # A later block has a value that doesn't fit the type inferred
+            # for its column. Read that column as strings from here on, like
+            # pd.read_csv's mixed type columns
+            match = re.search(r"column #(\d+)", str(error))
+            if match is None:
+                raise
+            column = reader.schema.names[int(match.group(1))]
+            if column_types[column] == pa.string():
+                raise
+            column_types[column] = pa.string()
+
+
+def _open_csv(path: str, skip_rows: int, block_size: int,
+              column_types: dict = None) -> pacsv.CSVStreamingReader:
+    return pacsv.open_csv(
+        pa.memory_map(path),
+        read_options=pacsv.ReadOptions(block_size=block_size,
+                                       skip_rows_after_names=skip_rows),
+        convert_options=pacsv.ConvertOptions(column_types=column_types,
+                                             strings_can_be_null=True))
@@ -0,0 +1,140 @@
+from data_structures.key import ENTITY_CLASSES
+
+from typing import Dict, Iterable, List, Tuple
+
+
+# Nodes of each entity type carry the type's class name as a label next to
+# Entity, e.g. (:Entity:Individual), so each type can have its own indexes
+ENTITY_LABELS = {entity_type: cls.__name__ for entity_type, cls in
+                 ENTITY_CLASSES.items()}
+
+
+# Constraints and indexes the ingest queries rely on. entity_id is how the
+# pipeline finds nodes, id is what Neo4jVector.add_embeddings merges on and
+# batch_seq picks out the nodes of the current batch. MergedEntity nodes
+# record which node each collapsed node was merged into
+SCHEMA = [
+    "CREATE CONSTRAINT entity_id_unique IF NOT EXISTS FOR (n:Entity) "
+    "REQUIRE n.entity_id IS UNIQUE",
+    "CREATE RANGE INDEX entity_vector_id IF NOT EXISTS FOR (n:Entity) "
+    "ON (n.id)",
+    "CREATE RANGE INDEX entity_row_index IF NOT EXISTS FOR (n:Entity) "
+    "ON (n.row_index)",
+    "CREATE RANGE INDEX entity_batch_seq IF NOT EXISTS FOR (n:Entity) "
+    "ON (n.batch_seq)",
+    "CREATE CONSTRAINT ingest_state_name IF NOT EXISTS FOR (n:IngestState) "
+    "REQUIRE n.name IS UNIQUE",
+    "CREATE CONSTRAINT merged_entity_id IF NOT EXISTS FOR (n:MergedEntity) "
+    "REQUIRE n.entity_id IS UNIQUE",
+    "CREATE RANGE INDEX merged_entity_into IF NOT EXISTS FOR "
+    "(n:MergedEntity) ON (n.into)",
+]
+
+# Plan operators that read every node, or every node with a label, rather
+# than looking nodes up in an index
+SCAN_OPERATORS = ["AllNodesScan", "NodeByLabelScan"]
+
+
+def entity_label(entity_type: str) -> str:
+    if entity_type not in ENTITY_LABELS:
+        raise ValueError(f"Unknown entity type {entity_type}")
+    return ENTITY_LABELS[entity_type]
+
+
+def vector_index_name(entity_type: str) -> str:
+    """Name of the vector index over the embeddings of one entity type"""
+    return f"vector_{entity_type}"
+
+
+def label_entities(session, entity_types: Iterable[str],
+                   batch_size: int = 10000):
+    """Add the entity type label to existing nodes that are missing it"""
+    for entity_type in entity_types:
+        label = entity_label(entity_type)
+        session.run("MATCH (n:Entity) WHERE n.entity_type = $entity_type "
+                    f"AND NOT n:{label} "
+                    f"CALL {{ WITH n SET n:{label} }} "
+                    f"IN TRANSACTIONS OF {batch_size} ROWS",
+                    entity_type=entity_type).consume()
+
+
+def set_entity_labels(tx, entity_ids: List[str], entity_types: List[str]):
+    """Add the entity type label to newly written nodes"""
+    by_type = {}
+    for entity_id, entity_type in zip(entity_ids, entity_types):
+        by_type.setdefault(entity_type, []).append(entity_id)
+    for entity_type, ids in by_type.items():
+        tx.run("UNWIND $ids AS id MATCH (n:Entity {entity_id: id}) "
+               f"SET n:{entity_label(entity_type)}", ids=ids)
+
+
+def create_schema(session):
+    """Create the constraints and indexes in SCHEMA if they don't exist"""
+    for query in SCHEMA:
+        session.run(query).consume()
+
+
+def _scans(plan: dict) -> List[str]:
+    operators = [plan["operatorType"]] if any(
+        plan["operatorType"].startswith(scan) for scan in SCAN_OPERATORS) \
+        else []
+    for child in plan.get("children", []):
+        operators += _scans(child)
+    return operators
+
+
+def check_index_seeks(session, queries: Dict[str, Tuple[str, dict]]
+                      ) -> Dict[str, List[str]]:
+    """EXPLAIN queries without running them and find the ones that scan
+    nodes instead of seeking them in an index
+    Args:
+        session: Session of the graph db
+        queries: Query and example parameters by name
+    Returns:
+        The scan operators in the plan of each query that has any, by name
+    """
+    scans = {}
+    for name, (query, params) in queries.items():
+        plan = session.run("EXPLAIN " + query, params).consume().plan
+        operators = _scans(plan)
+        if len(operators):
+            scans[name] = operators
+    return scans
+
+
+def create_vector_indexes(session, entity_types: Iterable[str],
+                          dimensions: int = 1536,
+                          similarity_function: str = "cosine",
+                          timeout: int = 600):
+    """Create a vector index over the embeddings of each entity type's nodes
+    if it doesn't exist yet, waiting until they are online. Raises a
+    ValueError if an existing index has different dimensions, as it leaves
+    out every embedding and can't be changed in place
+    Args:
+        session: Session of the graph db
+        entity_types: Entity types to create indexes for
+        dimensions: Dimension of the embeddings
+        similarity_function: Similarity the index ranks neighbours by
+        timeout: Seconds to wait for the indexes to come online
+    """
+    if similarity_function not in ["cosine", "euclidean"]:
+        raise ValueError(f"Unknown similarity function {similarity_function}")
+    existing = {record["name"]: record["dimensions"] for record in
+                session.run("SHOW VECTOR INDEXES YIELD name, options RETURN "
+                            "name, options.indexConfig['vector.dimensions'] "
+                            "AS dimensions")}
+    for entity_type in entity_types:
+        name = vector_index_name(entity_type)
+        if name in existing and existing[name] != int(dimensions):
+            raise ValueError(f"Vector index {name} has {existing[name]} "
+                             f"dimensions but the embeddings have "
+                             f"{int(dimensions)}, drop it with `DROP INDEX "
+                             f"{name}` to have it recreated")
+        # Schema commands don't take parameters
+        session.run(f"CREATE VECTOR INDEX {vector_index_name(entity_type)} "
+                    f"IF NOT EXISTS FOR (n:{entity_label(entity_type)}) "
+                    "ON (n.embedding) OPTIONS {indexConfig: {"
+                    f"`vector.dimensions`: {int(dimensions)}, "
+                    f"`vector.similarity_function`: '{similarity_function}'"
+                    "}}").consume()
+    session.run("CALL db.awaitIndexes($timeout)", timeout=timeout).consume()
@@ -23,15 +23,26 @@ class GraphDBPipeline:
         """
         Resolves entity and updates pinecone vetor store and graph db if necessary
         """
+        entities, scores, matches, new_entities = self.resolve_entities(
+            entities)
+        if not self.test and len(new_entities):
+            self.neo4j_conn.create_nodes(new_entities)
+        return entities, scores, matches
+
+    def resolve_entities(self, entities: List[Entity]):
+        """
+        Resolves entities against the pinecone vector store, also returning
+        the unmatched entities that need nodes in the graph db
+        """
         ids = []
         scores = []
         matches = []
+        new_entities = []
         for entity in entities:
             pinecone_id, matched_entity, score = self.entity_resolver.resolve(entity)
             entity.id = pinecone_id
             if matched_entity is None:
-                if not self.test:
-                    self.neo4j_conn.create_node(entity)
+                new_entities.append(entity)
             else:
                 query_dict = {f"query_{key}": value for key, value in
                               asdict(entity).items()}
@@ -42,7 +53,7 @@ class GraphDBPipeline:
 
             ids.append(pinecone_id)
             scores.append(score)
-        return entities, scores, matches
+        return entities, scores, matches, new_entities
 
     def upsert_relationship_edge(self, entity_node_ids, relationship_data: Relationship):
         pass
@@ -59,18 +70,31 @@ class GraphDBPipeline:
         scores_all = []
         ms_all = []
         for batch_res in query_res.fetch_pandas_batches():
+            batch_entities = []
+            batch_relationships = []
+            origin_entities = []
+            terminal_entities = []
             for _, row in batch_res.iterrows():
                 entities, relationships, entity_relationship_idx = data_key.build(row)
-                entities, scores, matches = self.upsert_entities(entities)
+                entities, scores, matches, new_entities = \
+                    self.resolve_entities(entities)
+                batch_entities += new_entities
                 scores_all += scores
                 ms_all += matches
 
-                if not self.test:
-                    for relationship, entity_idxs in zip(relationships,
-                                                         entity_relationship_idx):
-                        self.neo4j_conn.create_edge(relationship,
-                                                    entities[entity_idxs[0]],
-                                                    entities[entity_idxs[1]])
+                for relationship, entity_idxs in zip(relationships,
+                                                     entity_relationship_idx):
+                    batch_relationships.append(relationship)
+                    origin_entities.append(entities[entity_idxs[0]])
+                    terminal_entities.append(entities[entity_idxs[1]])
+
+            # Nodes and then edges of the whole batch are created together
+            if not self.test and len(batch_entities):
+                self.neo4j_conn.create_nodes(batch_entities)
+            if not self.test and len(batch_relationships):
+                self.neo4j_conn.create_edges(batch_relationships,
+                                             origin_entities,
+                                             terminal_entities)
 
         df = pd.DataFrame(ms_all)
         df.to_csv("matches.csv", index=False)
@@ -0,0 +1,94 @@
+from neo4j_connection import Neo4jConnection
+
+from typing import List, Optional
+
+import argparse
+import streamlit as st
+
+
+# Identity edges are undirected: one edge per unordered pair of nodes, stored
+# from the node with the smaller element id to the one with the larger
+
+# Expects rows of n, m, score and name_score. Keeps the highest scoring of
+# duplicate candidates for the same pair
+MERGE_EDGE = """
+WITH CASE WHEN elementId(n) < elementId(m) THEN n ELSE m END AS a,
+CASE WHEN elementId(n) < elementId(m) THEN m ELSE n END AS b,
+score, name_score
+MERGE (a)-[rel:Identity]->(b)
+ON CREATE SET rel.score = score, rel.name_score = name_score
+WITH rel, score, name_score
+WHERE score > rel.score
+SET rel.score = score, rel.name_score = name_score"""
+
+# Expects rows of a and b with elementId(a) < elementId(b). Merging nodes can
+# leave several edges, in either direction, between a pair; keep the highest
+# scoring one and point it from a to b
+CANONICALIZE_PAIR = """
+MATCH (a)-[rel:Identity]-(b)
+WITH a, b, rel
+ORDER BY rel.score DESC
+WITH a, b, collect(rel) AS rels
+WITH a, b, rels[0] AS top, rels[1..] AS rest
+FOREACH (rel IN rest | DELETE rel)
+WITH a, b, top
+WHERE startNode(top) <> a
+CREATE (a)-[rel:Identity]->(b)
+SET rel = properties(top)
+DELETE top"""
+
+
+# New nodes are found by the batch_seq index and merged nodes by the
+# entity_id constraint; an OR of the two would scan every node
+ANCHOR = """CALL {
+MATCH (n:Entity) WHERE n.batch_seq = $batch_seq RETURN n
+UNION
+MATCH (n:Entity) WHERE n.entity_id IN $entity_ids RETURN n
+}
+"""
+
+CANONICALIZE = ANCHOR + """MATCH (n)-[:Identity]-(m) WHERE n <> m
+WITH DISTINCT
+CASE WHEN elementId(n) < elementId(m) THEN n ELSE m END AS a,
+CASE WHEN elementId(n) < elementId(m) THEN m ELSE n END AS b""" + \
+    CANONICALIZE_PAIR
+
+DELETE_SELF_LOOPS = ANCHOR + "MATCH (n)-[rel:Identity]-(n) DELETE rel"
+
+
+def canonicalize(tx, batch_seq: int,
+                 entity_ids: Optional[List[str]] = None):
+    """Canonicalize the identity edges of nodes written in batch batch_seq or
+    with one of entity_ids, and delete their identity self loops"""
+    for query in [CANONICALIZE, DELETE_SELF_LOOPS]:
+        tx.run(query, batch_seq=batch_seq, entity_ids=entity_ids or [])
+
+
+def migrate(neo4j_conn: Neo4jConnection, batch_size: int = 1000):
+    """Convert a graph with symmetric identity edges, one per direction, to
+    one edge per pair"""
+    with neo4j_conn.session() as session:
+        session.run("MATCH (a)-[:Identity]-(b) "
+                    "WHERE elementId(a) < elementId(b) "
+                    "WITH DISTINCT a, b "
+                    "CALL { WITH a, b" + CANONICALIZE_PAIR +
+                    f"\n}} IN TRANSACTIONS OF {batch_size} ROWS").consume()
+        session.run("MATCH (a)-[rel:Identity]-(a) "
+                    "CALL { WITH rel DELETE rel } "
+                    f"IN TRANSACTIONS OF {batch_size} ROWS").consume()
+        count = session.run("MATCH ()-[rel:Identity]->() "
+                            "RETURN count(rel) AS count").single()["count"]
+    print(f"{count} identity edges after migration")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert symmetric identity edges to one undirected edge "
+        "per pair of nodes")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="Number of pairs migrated per transaction")
+    args = parser.parse_args()
+    neo4j_conn = Neo4jConnection(st.secrets.neo4j.uri, st.secrets.neo4j.user,
+                                 st.secrets.neo4j.pwd)
+    migrate(neo4j_conn, batch_size=args.batch_size)
+    neo4j_conn.close()
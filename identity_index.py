@@ -0,0 +1,311 @@
+from typing import Dict, List, Optional, Tuple
+from collections import defaultdict
+
+from blocking import Blocker
+
+import numpy as np
+
+
+class IVFIndex:
+
+    def __init__(self, dim: int, nlist: int = 256, nprobe: int = 8,
+                 train_size: Optional[int] = None, kmeans_iters: int = 10,
+                 seed: int = 0):
+        """Inverted file index over unit vectors using inner product. Until
+        enough vectors have been added to train the coarse quantizer every
+        search is exact
+        Args:
+            dim: Dimension of the vectors
+            nlist: Number of clusters the vectors are partitioned into
+            nprobe: Number of nearest clusters searched per query
+            train_size: Number of vectors to collect before training, defaults
+                to 40 per cluster
+            kmeans_iters: Number of k-means iterations when training
+            seed: Random seed for picking initial centroids
+        """
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size or 40 * nlist
+        self.kmeans_iters = kmeans_iters
+        self.rng = np.random.default_rng(seed)
+        self._vectors = np.zeros((1024, dim), dtype=np.float32)
+        # Positions of vectors that were removed, left out of searches
+        self._removed = np.zeros(1024, dtype=bool)
+        self._size = 0
+        self.centroids = None
+        self._lists = None
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:self._size]
+
+    @property
+    def removed(self) -> np.ndarray:
+        return self._removed[:self._size]
+
+    def _grow(self, size: int):
+        capacity = self._vectors.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:self._size] = self.vectors
+        self._vectors = vectors
+        removed = np.zeros(capacity, dtype=bool)
+        removed[:self._size] = self.removed
+        self._removed = removed
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=-1)
+
+    def _train(self):
+        vectors = self.vectors
+        init = self.rng.choice(len(vectors), self.nlist, replace=False)
+        centroids = vectors[init].copy()
+        for _ in range(self.kmeans_iters):
+            assignment = np.argmax(vectors @ centroids.T, axis=-1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            norms = np.linalg.norm(sums, axis=-1, keepdims=True)
+            # Keep the old centroid for clusters that lost all their vectors
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12),
+                                 centroids)
+        self.centroids = centroids
+        assignment = self._assign(vectors)
+        self._lists = [list(np.flatnonzero(assignment == i)) for i in
+                       range(self.nlist)]
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        """Add vectors, returning their positions in the index"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        positions = np.arange(self._size, self._size + len(vectors))
+        self._grow(self._size + len(vectors))
+        self._vectors[positions] = vectors
+        self._size += len(vectors)
+        if self.centroids is not None:
+            for position, cluster in zip(positions, self._assign(vectors)):
+                self._lists[cluster].append(position)
+        elif self._size >= max(self.train_size, self.nlist):
+            self._train()
+        return positions
+
+    def remove(self, positions: np.ndarray):
+        """Leave the vectors at positions out of future searches"""
+        self._removed[np.asarray(positions, dtype=np.int64)] = True
+
+    def search(self, queries: np.ndarray, k: int
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate k nearest neighbours of each query by inner product.
+        Returns positions and scores, padded with -1 and -inf where fewer than
+        k vectors were searched"""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if self._size == 0:
+            return positions, scores
+
+        if self.centroids is None:
+            candidate_sets = [np.arange(self._size)] * len(queries)
+        else:
+            probes = np.argsort(-(queries @ self.centroids.T),
+                                axis=-1)[:, :self.nprobe]
+            candidate_sets = [np.concatenate([self._lists[c] for c in probe])
+                              .astype(np.int64) for probe in probes]
+
+        for i, (query, candidates) in enumerate(zip(queries, candidate_sets)):
+            candidates = candidates[~self._removed[candidates]]
+            if len(candidates) == 0:
+                continue
+            candidate_scores = self._vectors[candidates] @ query
+            top = np.argsort(-candidate_scores)[:k]
+            positions[i, :len(top)] = candidates[top]
+            scores[i, :len(top)] = candidate_scores[top]
+        return positions, scores
+
+
+class IdentityIndex:
+
+    def __init__(self, dim: int = 1536, name_dim: int = 768,
+                 blocker: Optional[Blocker] = None,
+                 recall_sample_rate: float = 0.01, seed: int = 0,
+                 **ivf_kwargs):
+        """In process approximate nearest neighbour index over entity
+        embeddings, one IVFIndex per entity type, producing identity edge
+        candidates without querying the database's vector index
+        Args:
+            dim: Dimension of the entity embeddings
+            name_dim: Size of the name part at the start of each embedding
+            blocker: If given, only score entities sharing a block instead
+                of searching the IVF index
+            recall_sample_rate: Fraction of blocked queries also searched
+                exhaustively to measure the pairs lost to blocking
+            seed: Random seed for sampling recall queries
+            ivf_kwargs: Keyword arguments passed to each IVFIndex
+        """
+        self.dim = dim
+        self.name_dim = name_dim
+        self.blocker = blocker
+        self.recall_sample_rate = recall_sample_rate
+        self.rng = np.random.default_rng(seed)
+        self.ivf_kwargs = ivf_kwargs
+        self._indexes = {}
+        self._ids = defaultdict(list)
+        # Entity type and position of each id's entries
+        self._positions = defaultdict(list)
+        self._suffix = defaultdict(list)
+        self._gender = defaultdict(list)
+
+    def __len__(self):
+        return sum(len(index) for index in self._indexes.values())
+
+    def _index(self, entity_type: str) -> IVFIndex:
+        if entity_type not in self._indexes:
+            self._indexes[entity_type] = IVFIndex(self.dim, **self.ivf_kwargs)
+        return self._indexes[entity_type]
+
+    @staticmethod
+    def _group(entity_types: List[str]) -> Dict[str, np.ndarray]:
+        groups = defaultdict(list)
+        for i, entity_type in enumerate(entity_types):
+            groups[entity_type].append(i)
+        return {key: np.array(idxs) for key, idxs in groups.items()}
+
+    def add(self, ids: List[str], embeddings: np.ndarray, metadata:
+            List[dict]):
+        """Add entities to the index
+        Args:
+            ids: Node id of each entity
+            embeddings: Embedding of each entity
+            metadata: Node properties of each entity, used for its
+                entity_type, suffix and gender
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(
+            -1, self.dim)
+        groups = self._group([md["entity_type"] for md in metadata])
+        for entity_type, idxs in groups.items():
+            positions = self._index(entity_type).add(embeddings[idxs])
+            if self.blocker is not None:
+                self.blocker.add(positions, [metadata[i] for i in idxs])
+            self._ids[entity_type] += [ids[i] for i in idxs]
+            for i, position in zip(idxs, positions):
+                self._positions[ids[i]].append((entity_type, position))
+            self._suffix[entity_type] += [metadata[i].get("suffix") for i in
+                                          idxs]
+            self._gender[entity_type] += [metadata[i].get("gender") for i in
+                                          idxs]
+
+    def remove(self, ids: List[str]):
+        """Leave entities out of future candidates, e.g. because their nodes
+        were merged into another node"""
+        for entity_id in ids:
+            for entity_type, position in self._positions.pop(entity_id, []):
+                self._indexes[entity_type].remove([position])
+
+    def _name_scores(self, index: IVFIndex, query: np.ndarray,
+                     positions: np.ndarray) -> np.ndarray:
+        names = index.vectors[positions, :self.name_dim]
+        query_name = query[:self.name_dim]
+        cosine = names @ query_name / np.maximum(
+            np.linalg.norm(names, axis=-1) * np.linalg.norm(query_name), 1e-12)
+        return (1 + cosine) / 2
+
+    def candidate_pairs(self, ids: List[str], embeddings: np.ndarray,
+                        metadata: List[dict], k: int = 5,
+                        threshold: float = 0.96) -> List[dict]:
+        """Identity edge candidates between the given entities and everything
+        in the index of the same entity type. Scores follow Neo4j's cosine
+        similarity, (1 + cosine) / 2, and the same suffix and gender checks as
+        `GraphDBPipeline.add_identity_edges` are applied
+        Args:
+            ids: Node id of each query entity
+            embeddings: Embedding of each query entity
+            metadata: Node properties of each query entity
+            k: Number of neighbours retrieved per entity
+            threshold: Score above which pairs are returned
+        Returns:
+            List of dicts with source, target, score and name_score
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(
+            -1, self.dim)
+        pairs = []
+        groups = self._group([md["entity_type"] for md in metadata])
+        for entity_type, idxs in groups.items():
+            if entity_type not in self._indexes:
+                continue
+            index = self._indexes[entity_type]
+            index_ids = self._ids[entity_type]
+            suffixes = self._suffix[entity_type]
+            genders = self._gender[entity_type]
+            # One extra neighbour since each entity finds itself
+            if self.blocker is None:
+                positions, scores = index.search(embeddings[idxs], k + 1)
+            else:
+                positions, scores = self._search_blocks(
+                    index, index_ids, embeddings[idxs],
+                    [ids[i] for i in idxs], [metadata[i] for i in idxs],
+                    k + 1, threshold)
+            scores = (1 + scores) / 2
+            for i, row_positions, row_scores in zip(idxs, positions, scores):
+                keep = [j for j, (position, score) in
+                        enumerate(zip(row_positions, row_scores)) if
+                        position >= 0 and score > threshold and
+                        index_ids[position] != ids[i]][:k]
+                keep = [j for j in keep if
+                        _compatible(metadata[i].get("suffix"),
+                                    suffixes[row_positions[j]]) and
+                        _compatible(metadata[i].get("gender"),
+                                    genders[row_positions[j]])]
+                if len(keep) == 0:
+                    continue
+                name_scores = self._name_scores(index, embeddings[i],
+                                                row_positions[keep])
+                for j, name_score in zip(keep, name_scores):
+                    pairs.append({"source": ids[i],
+                                  "target": index_ids[row_positions[j]],
+                                  "score": float(row_scores[j]),
+                                  "name_score": float(name_score)})
+        return pairs
+
+
+    def _search_blocks(self, index: IVFIndex, index_ids: List[str],
+                       queries: np.ndarray, query_ids: List[str],
+                       metadata: List[dict], k: int, threshold: float
+                       ) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact k nearest neighbours of each query among the entities
+        sharing one of its blocks, in the same format as `IVFIndex.search`"""
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        # Neo4j scores are (1 + cosine) / 2
+        cosine_threshold = 2 * threshold - 1
+        for i, (query, query_id, entity_dict) in enumerate(zip(queries,
+                                                               query_ids,
+                                                               metadata)):
+            candidates = np.array(self.blocker.candidates(entity_dict,
+                                                          len(index)),
+                                  dtype=np.int64)
+            candidates = candidates[~index.removed[candidates]]
+            if self.rng.random() < self.recall_sample_rate:
+                all_scores = index.vectors @ query
+                # Drop the query itself, it's in the index already
+                true_pairs = np.array([j for j in np.flatnonzero(
+                    (all_scores > cosine_threshold) & ~index.removed) if
+                                       index_ids[j] != query_id],
+                                      dtype=np.int64)
+                self.blocker.record_recall(
+                    len(true_pairs), len(np.setdiff1d(true_pairs, candidates)))
+            if len(candidates) == 0:
+                continue
+            candidate_scores = index.vectors[candidates] @ query
+            top = np.argsort(-candidate_scores)[:k]
+            positions[i, :len(top)] = candidates[top]
+            scores[i, :len(top)] = candidate_scores[top]
+        return positions, scores
+
+
+def _compatible(a, b) -> bool:
+    return a is None or b is None or a == b
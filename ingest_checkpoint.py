@@ -0,0 +1,77 @@
+from typing import List, Optional
+from pathlib import Path
+
+import os
+import json
+import time
+import hashlib
+
+
+class IngestCheckpoint:
+
+    def __init__(self, path: str, table_key: str, source: str,
+                 order_by: List[str], csv_file: Optional[str] = None):
+        """Manifest recording how far the ingest of a table has been
+        committed, rewritten after every batch so a crashed ingest can be
+        resumed from the first uncommitted row
+        Args:
+            path: File the manifest is kept in
+            table_key: Path to the table key json being ingested
+            source: Query the rows come from
+            order_by: Columns the rows are ordered by
+            csv_file: csv or Parquet file the rows come from instead of the
+                query. Its size and modification time are hashed, so a file
+                that has been rewritten can't be resumed from
+        """
+        self.path = Path(path)
+        self.table_key = table_key
+        if csv_file is not None:
+            stat = os.stat(csv_file)
+            source = f"{stat.st_size}:{stat.st_mtime_ns}"
+        self.source_hash = hashlib.sha1(source.encode("utf-8")).hexdigest()
+        self.order_by = list(order_by)
+        self.offset = 0
+
+    def _manifest(self) -> dict:
+        return {"table_key": self.table_key,
+                "source_hash": self.source_hash,
+                "order_by": self.order_by,
+                "offset": self.offset,
+                "updated": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+    def resume(self) -> int:
+        """Load the committed offset from the manifest, checking it was
+        written for the same table, source and ordering"""
+        with open(self.path, "r") as ifile:
+            manifest = json.load(ifile)
+        for name in ["table_key", "source_hash", "order_by"]:
+            if manifest[name] != self._manifest()[name]:
+                raise ValueError(f"Checkpoint {self.path} was written with a "
+                                 f"different {name}, can't resume from it")
+        self.offset = manifest["offset"]
+        return self.offset
+
+    def commit(self, offset: int):
+        """Record that every row before offset has been ingested"""
+        self.offset = offset
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as ofile:
+            json.dump(self._manifest(), ofile, indent=4)
+            ofile.flush()
+            os.fsync(ofile.fileno())
+        # Atomic, so a crash leaves either the old or the new manifest
+        os.replace(tmp_path, self.path)
+
+
+def ordered_query(query: str, order_by: List[str], offset: int = 0,
+                  limit: Optional[int] = None) -> str:
+    """Wrap a Snowflake query so its rows come back in a deterministic order,
+    skipping the first offset rows"""
+    columns = ", ".join([f'"{column}"' for column in order_by])
+    query = f"select * from ({query.strip().rstrip(';')}) "\
+        f"order by {columns}"
+    if offset or limit is not None:
+        query += f" limit {'null' if limit is None else int(limit)} "\
+            f"offset {int(offset)}"
+    return query
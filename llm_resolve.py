@@ -48,7 +48,7 @@ class LLMResolver(ConversationOpenAI):
                             float = 0.98,
                             neighbor_threshold: Optional[float] = None):
 
-        query = "MATCH  p=(n)-[rel:Identity]-(b)\n"\
+        query = "MATCH  p=(n:Entity)-[rel:Identity]-(b:Entity)\n"\
         f"WHERE rel.score>{threshold} and"\
         f" rel.name_score>{name_threshold} and NOT (\n"\
           """n.middle_name is not null AND 
@@ -57,9 +57,9 @@ class LLMResolver(ConversationOpenAI):
           )"""
         if neighbor_threshold is not None:
             query += f" and rel.neighbor_score > {neighbor_threshold}\n"
-        query += "RETURN n, collect(b);"""
+        query += "RETURN n, collect(DISTINCT b);"""
 
-        res = self.neo4j_conn.query(query)
+        res = self.neo4j_conn.query(query, routing="r")
         for node, matches in res:
             entities = [node] + matches
             entities_text = [n["text"] for n in entities]
@@ -67,16 +67,16 @@ class LLMResolver(ConversationOpenAI):
             for cluster_idx, score in zip(clusters, scores):
                 if len(cluster_idx)>1:
                     node_ids = [entities[i]["entity_id"] for i in cluster_idx]
-                    with self.neo4j_conn._Neo4jConnection__driver.session() as session:
-                        session.execute_write(self.add_llm_scores, node_ids,
-                                              threshold, name_threshold,
-                                              neighbor_threshold, score)
+                    self.neo4j_conn.execute_write(self.add_llm_scores,
+                                                  node_ids, threshold,
+                                                  name_threshold,
+                                                  neighbor_threshold, score)
 
     @staticmethod
     def add_llm_scores(tx, node_ids, threshold, name_threshold,
                        neighbor_threshold, score):
-        query = f"MATCH p=(n)-"\
-                "[rel:Identity]-(b)\n"\
+        query = f"MATCH p=(n:Entity)-"\
+                "[rel:Identity]-(b:Entity)\n"\
         f"WHERE n.entity_id IN {node_ids} and"\
         f" b.entity_id IN {node_ids} and rel.score>{threshold} and"\
         f" rel.name_score>{name_threshold} and NOT (\n"\
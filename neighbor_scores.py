@@ -0,0 +1,200 @@
+from neo4j_connection import Neo4jConnection
+
+from typing import Dict, List, Optional, Tuple
+from multiprocessing import get_context
+
+import os
+import time
+import argparse
+import numpy as np
+import scipy.sparse as sp
+import streamlit as st
+
+
+# Set in each worker process by _init_worker
+_adjacency = None
+_undirected = None
+
+
+def _init_worker(adjacency: sp.csr_matrix, undirected: sp.csr_matrix):
+    global _adjacency, _undirected
+    _adjacency = adjacency
+    _undirected = undirected
+
+
+def _common_counts(pairs: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    sources, targets = pairs
+    common = _adjacency[sources].multiply(_undirected[targets])
+    return np.asarray(common.sum(axis=1)).ravel()
+
+
+class NeighborScorer:
+
+    def __init__(self, neo4j_conn: Neo4jConnection,
+                 relationship_type: str = "Contribution",
+                 score_property: Optional[str] = None,
+                 min_score: float = 0.98, num_workers: Optional[int] = None,
+                 chunk_size: int = 50000, write_batch_size: int = 10000):
+        """Computes the neighbor score of identity edges as a sparse matrix
+        product outside the database. The score of a pair (a, b) is the
+        number of common neighbours reached by a's outgoing relationships
+        and either direction of b's, divided by the sum of a's and b's
+        distinct outgoing neighbours, as in
+        `GraphDBPipeline.assign_neighbor_score`
+        Args:
+            neo4j_conn: Connection to the graph db
+            relationship_type: Relationship type neighbours are counted over
+            score_property: Identity edge property the score is written to,
+                defaults to neighbor_score for Contribution and
+                <type>_neighbor_score otherwise
+            min_score: Only identity edges scoring above this are scored
+            num_workers: Number of processes computing common neighbour
+                counts, defaults to the number of cores
+            chunk_size: Number of pairs handed to a worker at a time
+            write_batch_size: Number of scores written per transaction
+        """
+        self.neo4j_conn = neo4j_conn
+        self.relationship_type = relationship_type
+        if score_property is None:
+            score_property = "neighbor_score"
+            if relationship_type != "Contribution":
+                score_property = f"{relationship_type.lower()}_{score_property}"
+        if not score_property.isidentifier():
+            raise ValueError(f"Invalid score property {score_property}")
+        self.score_property = score_property
+        self.min_score = min_score
+        self.num_workers = num_workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.write_batch_size = write_batch_size
+
+    def load_adjacency(self) -> Tuple[sp.csr_matrix, Dict[str, int]]:
+        """Stream every relationship of relationship_type into a node by node
+        matrix of edge counts, returning it with the row of each node's
+        element id"""
+        query = f"MATCH (a)-[:{self.relationship_type}]->(b) "\
+            "RETURN elementId(a) AS a, elementId(b) AS b"
+        nodes = {}
+        rows = []
+        cols = []
+        with self.neo4j_conn.session() as session:
+            for record in session.run(query):
+                rows.append(nodes.setdefault(record["a"], len(nodes)))
+                cols.append(nodes.setdefault(record["b"], len(nodes)))
+        rows = np.array(rows, dtype=np.int64)
+        cols = np.array(cols, dtype=np.int64)
+        # Duplicate entries are summed, keeping edge multiplicities
+        adjacency = sp.coo_matrix((np.ones(len(rows), dtype=np.float64),
+                                   (rows, cols)),
+                                  shape=(len(nodes), len(nodes))).tocsr()
+        return adjacency, nodes
+
+    def load_identity_pairs(self) -> Tuple[List[str], List[str], List[str]]:
+        """Identity edges above min_score, as the edge's element id and its
+        endpoints ordered by element id"""
+        query = "MATCH (s)-[ident:Identity]->(e) "\
+            "WHERE ident.score > $min_score AND s <> e "\
+            "RETURN elementId(ident) AS id, elementId(s) AS s, "\
+            "elementId(e) AS e"
+        ids, sources, targets = [], [], []
+        with self.neo4j_conn.session() as session:
+            for record in session.run(query, min_score=self.min_score):
+                s, e = record["s"], record["e"]
+                ids.append(record["id"])
+                sources.append(min(s, e))
+                targets.append(max(s, e))
+        return ids, sources, targets
+
+    def scores(self, adjacency: sp.csr_matrix, nodes: Dict[str, int],
+               sources: List[str], targets: List[str]
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """Neighbor score of each pair, returning the indices of the pairs
+        that have one and their scores. Pairs without common neighbours or
+        where the target has no outgoing relationships get none"""
+        keep = np.array([s in nodes and t in nodes for s, t in
+                         zip(sources, targets)], dtype=bool)
+        pair_idxs = np.flatnonzero(keep)
+        if len(pair_idxs) == 0:
+            return pair_idxs, np.zeros(0)
+        src = np.array([nodes[sources[i]] for i in pair_idxs], dtype=np.int64)
+        term = np.array([nodes[targets[i]] for i in pair_idxs],
+                        dtype=np.int64)
+
+        # A self loop is a single undirected relationship, not two
+        undirected = (adjacency + adjacency.T -
+                      sp.diags(adjacency.diagonal())).tocsr()
+        chunks = [(src[start:start+self.chunk_size],
+                   term[start:start+self.chunk_size]) for start in
+                  range(0, len(src), self.chunk_size)]
+        if self.num_workers > 1 and len(chunks) > 1:
+            with get_context("spawn").Pool(
+                    self.num_workers, initializer=_init_worker,
+                    initargs=(adjacency, undirected)) as pool:
+                common = np.concatenate(pool.map(_common_counts, chunks))
+        else:
+            _init_worker(adjacency, undirected)
+            common = np.concatenate([_common_counts(chunk) for chunk in
+                                     chunks])
+
+        # Rows hold each node's distinct outgoing neighbours
+        out_degree = np.diff(adjacency.indptr)
+        scored = (common > 0) & (out_degree[term] > 0)
+        scores = common[scored] / (out_degree[src[scored]] +
+                                   out_degree[term[scored]])
+        return pair_idxs[scored], scores
+
+    def write(self, ids: List[str], scores: np.ndarray):
+        """Set the score property of the given identity edges, one transaction
+        per write_batch_size edges"""
+        query = "UNWIND $rows AS row "\
+            "MATCH ()-[ident:Identity]->() WHERE elementId(ident) = row.id "\
+            f"SET ident.{self.score_property} = row.score"
+        rows = [{"id": edge_id, "score": float(score)} for edge_id, score in
+                zip(ids, scores)]
+        with self.neo4j_conn.session():
+            for start in range(0, len(rows), self.write_batch_size):
+                self.neo4j_conn.execute_write(
+                    lambda tx, batch: tx.run(query, rows=batch).consume(),
+                    rows[start:start+self.write_batch_size])
+
+    def run(self):
+        """Score every identity edge above min_score"""
+        t = time.perf_counter()
+        adjacency, nodes = self.load_adjacency()
+        ids, sources, targets = self.load_identity_pairs()
+        print(f"Loaded {adjacency.nnz} {self.relationship_type} pairs between "
+              f"{len(nodes)} nodes and {len(ids)} identity edges in "
+              f"{time.perf_counter() - t:.1f}s")
+
+        t = time.perf_counter()
+        pair_idxs, scores = self.scores(adjacency, nodes, sources, targets)
+        print(f"Scored {len(pair_idxs)} identity edges in "
+              f"{time.perf_counter() - t:.1f}s")
+
+        t = time.perf_counter()
+        self.write([ids[i] for i in pair_idxs], scores)
+        print(f"Wrote {self.score_property} in {time.perf_counter() - t:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the neighbor score of every identity edge from a "
+        "sparse adjacency matrix and write it back to the graph")
+    parser.add_argument("--relationship-type", type=str, default="Contribution",
+                        help="Relationship type neighbours are counted over, "
+                        "e.g. Contribution or Violation")
+    parser.add_argument("--score-property", type=str, default=None,
+                        help="Identity edge property to write the score to")
+    parser.add_argument("--score-min", type=float, default=0.98,
+                        help="Score threshold above which identity edges are "
+                        "scored")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes computing common neighbours")
+    args = parser.parse_args()
+    neo4j_conn = Neo4jConnection(st.secrets.neo4j.uri, st.secrets.neo4j.user,
+                                 st.secrets.neo4j.pwd)
+    scorer = NeighborScorer(neo4j_conn, relationship_type=args.relationship_type,
+                            score_property=args.score_property,
+                            min_score=args.score_min,
+                            num_workers=args.workers)
+    scorer.run()
+    neo4j_conn.close()
@@ -1,53 +1,218 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, Driver, RoutingControl
 from data_structures import Entity, Relationship
+from typing import Dict, List, Optional
 from dataclasses import asdict
+from contextlib import contextmanager
+
+import threading
 
 
 class Neo4jConnection:
 
-    def __init__(self, uri, user, pwd):
+    def __init__(self, uri=None, user=None, pwd=None,
+                 database: Optional[str] = None,
+                 max_connection_pool_size: int = 100,
+                 connection_acquisition_timeout: float = 60.0,
+                 driver: Optional[Driver] = None):
+        """Connection to the graph db that everything querying it goes
+        through. The driver pools connections, and queries run inside a
+        `session` or `transaction` scope reuse that scope's session instead
+        of taking a new one from the pool. Inside a `transaction` scope they
+        run in that transaction
+        Args:
+            uri: Uri of the graph db
+            user: User name
+            pwd: Password
+            database: Database queries run against, the default one if not
+                given
+            max_connection_pool_size: Max number of connections the driver
+                keeps open
+            connection_acquisition_timeout: Seconds to wait for a free
+                connection from the pool before failing
+            driver: Existing driver to use instead of creating one
+        """
         self.__uri = uri
         self.__user = user
         self.__pwd = pwd
-        self.__driver = None
-        try:
-            self.__driver = GraphDatabase.driver(self.__uri, auth=(self.__user, self.__pwd))
-        except Exception as e:
-            print("Failed to create the driver:", e)
-
-    def _get_session(self):
-        return self.__driver.session() 
+        self.database = database
+        self.__driver = driver
+        # Session and explicit transaction of the open scopes, per thread
+        # since sessions aren't thread safe
+        self._local = threading.local()
+        if self.__driver is None:
+            try:
+                self.__driver = GraphDatabase.driver(
+                    self.__uri, auth=(self.__user, self.__pwd),
+                    max_connection_pool_size=max_connection_pool_size,
+                    connection_acquisition_timeout=connection_acquisition_timeout)
+            except Exception as e:
+                print("Failed to create the driver:", e)
 
     def close(self):
         if self.__driver is not None:
             self.__driver.close()
 
-    def query(self, query, parameters=None, db=None):
-        session = self._get_session()
-        response = list(session.run(query, parameters))
+    @contextmanager
+    def session(self, **kwargs):
+        """Session scope. Everything run through the connection inside it,
+        including nested scopes, uses this session"""
+        active = getattr(self._local, "session", None)
+        if active is not None:
+            yield active
+            return
+        with self.__driver.session(database=self.database, **kwargs) as session:
+            self._local.session = session
+            try:
+                yield session
+            finally:
+                self._local.session = None
+
+    @contextmanager
+    def transaction(self):
+        """Explicit transaction scope, committed when the scope exits and
+        rolled back if it raises. Queries and work run through the connection
+        inside it, including nested transaction scopes, join this
+        transaction, since its session can't run anything else while it's
+        open"""
+        active = getattr(self._local, "tx", None)
+        if active is not None:
+            yield active
+            return
+        with self.session() as session:
+            with session.begin_transaction() as tx:
+                self._local.tx = tx
+                try:
+                    yield tx
+                    tx.commit()
+                finally:
+                    self._local.tx = None
+
+    def execute_read(self, work, *args, **kwargs):
+        """Run work(tx, *args, **kwargs) in a managed read transaction,
+        routed to a reader and retried on transient errors, or in the open
+        explicit transaction"""
+        tx = getattr(self._local, "tx", None)
+        if tx is not None:
+            return work(tx, *args, **kwargs)
+        with self.session() as session:
+            return session.execute_read(work, *args, **kwargs)
+
+    def execute_write(self, work, *args, **kwargs):
+        """Run work(tx, *args, **kwargs) in a managed write transaction,
+        retried on transient errors, or in the open explicit transaction"""
+        tx = getattr(self._local, "tx", None)
+        if tx is not None:
+            return work(tx, *args, **kwargs)
+        with self.session() as session:
+            return session.execute_write(work, *args, **kwargs)
+
+    def query(self, query, parameters=None, db=None, routing: str = "w"):
+        """Run a single statement and return its records. Outside a session
+        scope the driver runs it on a pooled connection, routed to a reader
+        if routing is "r" """
+        tx = getattr(self._local, "tx", None)
+        if tx is not None:
+            return list(tx.run(query, parameters))
+        session = getattr(self._local, "session", None)
         if session is not None:
-            session.close()
-        return response
-
-    def create_node(self, entity: Entity):
-        session = self._get_session()
-        dict_str = ", ".join([f"{key}: '{val}'" for key, val in
-                              asdict(entity).items() if val is not None])
-        query = f"CREATE (n:{entity.entity_type} {{{dict_str}}})"
-        res = session.run(query)
-        session.close()
-        return res
+            return list(session.run(query, parameters))
+        records, _, _ = self.__driver.execute_query(
+            query, parameters, database_=db or self.database,
+            routing_=RoutingControl.READ if routing == "r" else
+            RoutingControl.WRITE)
+        return records
+
+    @staticmethod
+    def _chunks(rows: List[dict], batch_size: int):
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start+batch_size]
+
+    @staticmethod
+    def _write_rows(tx, query: str, rows: List[dict]) -> List[tuple]:
+        return [(record["idx"], record["id"]) for record in
+                tx.run(query, rows=rows)]
+
+    def _write_grouped(self, groups: Dict[tuple, List[dict]], query_fn,
+                       num_rows: int, batch_size: int) -> List[Optional[str]]:
+        """Write rows with one query per group and chunk, each chunk in its
+        own managed transaction unless a transaction scope is open, and
+        return the created element ids in the order of the rows' idx"""
+        ids = [None] * num_rows
+        with self.session():
+            for group, rows in groups.items():
+                query = query_fn(*group)
+                for chunk in self._chunks(rows, batch_size):
+                    for idx, element_id in self.execute_write(
+                            self._write_rows, query, chunk):
+                        ids[idx] = element_id
+        return ids
+
+    def create_nodes(self, entities: List[Entity], batch_size: int = 1000
+                     ) -> List[str]:
+        """Create a node per entity, labelled by its entity type, with
+        parameterized UNWIND statements of up to batch_size entities
+        Args:
+            entities: Entities to create nodes for
+            batch_size: Number of nodes created per transaction
+        Returns:
+            Element id of the node created for each entity
+        """
+        groups = {}
+        for idx, entity in enumerate(entities):
+            properties = {key: val for key, val in asdict(entity).items() if
+                          val is not None}
+            groups.setdefault((entity.entity_type,), []).append(
+                {"idx": idx, "properties": properties})
+
+        def query_fn(label):
+            return "UNWIND $rows AS row "\
+                f"CREATE (n:`{label}`) "\
+                "SET n = row.properties "\
+                "RETURN row.idx AS idx, elementId(n) AS id"
+        return self._write_grouped(groups, query_fn, len(entities),
+                                   batch_size)
+
+    def create_edges(self, relationships: List[Relationship],
+                     origin_entities: List[Entity],
+                     terminal_entities: List[Entity], batch_size: int = 1000
+                     ) -> List[Optional[str]]:
+        """Create an edge per relationship between the nodes of its origin
+        and terminal entity, matched on id, with parameterized UNWIND
+        statements of up to batch_size relationships
+        Args:
+            relationships: Relationships to create edges for
+            origin_entities: Origin entity of each relationship
+            terminal_entities: Terminal entity of each relationship
+            batch_size: Number of edges created per transaction
+        Returns:
+            Element id of the edge created for each relationship, None where
+            either node wasn't found
+        """
+        groups = {}
+        for idx, (relationship, origin, terminal) in enumerate(zip(
+                relationships, origin_entities, terminal_entities)):
+            properties = {key: val for key, val in
+                          asdict(relationship).items() if val is not None}
+            group = (relationship.relationship_type, origin.entity_type,
+                     terminal.entity_type)
+            groups.setdefault(group, []).append(
+                {"idx": idx, "source": origin.id, "terminal": terminal.id,
+                 "properties": properties})
+
+        def query_fn(relationship_type, origin_label, terminal_label):
+            return "UNWIND $rows AS row "\
+                f"MATCH (a:`{origin_label}` {{id: row.source}}) "\
+                f"MATCH (b:`{terminal_label}` {{id: row.terminal}}) "\
+                f"CREATE (a)-[r:`{relationship_type}`]->(b) "\
+                "SET r = row.properties "\
+                "RETURN row.idx AS idx, elementId(r) AS id"
+        return self._write_grouped(groups, query_fn, len(relationships),
+                                   batch_size)
+
+    def create_node(self, entity: Entity) -> str:
+        return self.create_nodes([entity])[0]
 
     def create_edge(self, relationship: Relationship, origin_entity: Entity,
-                    terminal_entity: Entity):
-        session = self._get_session()
-        property_str = ", ".join([f"r.{key}='val'" for key, val in
-                                 asdict(relationship).items() if val is not
-                                 None])
-        query = f"MATCH (a:{origin_entity.entity_type}), "\
-        f"(b:{terminal_entity.entity_type}) WHERE a.id = $id1 AND b.id = $id2"\
-        f" CREATE (a)-[r:{relationship.relationship_type}]->(b) "\
-        f" SET {property_str}"
-        res = session.run(query, id1=origin_entity.id, id2=terminal_entity.id)
-        session.close()
-        return res
+                    terminal_entity: Entity) -> Optional[str]:
+        return self.create_edges([relationship], [origin_entity],
+                                 [terminal_entity])[0]
@@ -0,0 +1,153 @@
+from typing import List
+from pathlib import Path
+
+import json
+import argparse
+import numpy as np
+
+
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model.int8.onnx"
+CONFIG_FILE = "encoder_config.json"
+
+
+def export_quantized(model_name: str, output_dir: str, opset: int = 14):
+    """Export a sentence transformer's transformer to ONNX and quantize its
+    weights to int8. The tokenizer and pooling settings are saved alongside
+    so `OnnxEncoder` can reproduce the model's `encode`
+    Args:
+        model_name: Name of the sentence transformer model
+        output_dir: Directory to write the model files to
+        opset: ONNX opset version to export with
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+    try:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+    except ImportError as exc:
+        raise ImportError(
+            "Could not import onnxruntime python package. "
+            "Please install it with `pip install onnxruntime`."
+        ) from exc
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+    pooling = [module for module in model if isinstance(module, Pooling)][0]
+    normalize = any(isinstance(module, Normalize) for module in model)
+
+    input_names = [name for name in ["input_ids", "attention_mask",
+                                     "token_type_ids"]
+                   if name in tokenizer.model_input_names]
+    dummy = tokenizer(["an individual named example"], return_tensors="pt")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in
+                    input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(transformer,
+                          tuple(dummy[name] for name in input_names),
+                          str(output_dir / MODEL_FILE),
+                          input_names=input_names,
+                          output_names=["last_hidden_state"],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset)
+    quantize_dynamic(str(output_dir / MODEL_FILE),
+                     str(output_dir / QUANTIZED_MODEL_FILE),
+                     weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(str(output_dir))
+    with open(output_dir / CONFIG_FILE, "w") as ofile:
+        json.dump({"model_name": model_name,
+                   "input_names": input_names,
+                   "pooling": pooling.get_pooling_mode_str(),
+                   "normalize": normalize,
+                   "max_seq_length": model.max_seq_length}, ofile, indent=4)
+
+
+class OnnxEncoder:
+
+    def __init__(self, model_dir: str, quantized: bool = True,
+                 batch_size: int = 64, num_threads: int = 0):
+        """Runs a sentence transformer exported by `export_quantized` with
+        onnxruntime. Can be set as the encoder of an EntityEmbedder
+        Args:
+            model_dir: Directory written by `export_quantized`
+            quantized: Use the int8 model rather than the full precision one
+            batch_size: Number of texts run through the model at a time
+            num_threads: Number of intra op threads, 0 lets onnxruntime decide
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError as exc:
+            raise ImportError(
+                "Could not import onnxruntime python package. "
+                "Please install it with `pip install onnxruntime`."
+            ) from exc
+        from transformers import AutoTokenizer
+
+        model_dir = Path(model_dir)
+        with open(model_dir / CONFIG_FILE, "r") as ifile:
+            self.config = json.load(ifile)
+        if self.config["pooling"] not in ["mean", "cls"]:
+            raise ValueError(f"Pooling mode {self.config['pooling']} is not "
+                             "supported")
+        self.model_name = self.config["model_name"]
+        # Vectors differ from the full precision model's, so they're cached
+        # under their own name
+        self.cache_name = f"{self.model_name}:onnx-int8" if quantized else \
+            f"{self.model_name}:onnx"
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        model_file = QUANTIZED_MODEL_FILE if quantized else MODEL_FILE
+        self.session = ort.InferenceSession(str(model_dir / model_file),
+                                            options,
+                                            providers=["CPUExecutionProvider"])
+
+    def _pool(self, hidden: np.ndarray, attention_mask: np.ndarray
+              ) -> np.ndarray:
+        if self.config["pooling"] == "cls":
+            return hidden[:, 0]
+        mask = attention_mask[..., None].astype(hidden.dtype)
+        return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9,
+                                                     None)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts, returning vectors in input order"""
+        texts = [text.replace("\n", " ") for text in texts]
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        # Batch texts of similar length together to cut padding
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        sorted_vecs = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = [texts[i] for i in order[start:start+self.batch_size]]
+            inputs = self.tokenizer(batch, padding=True, truncation=True,
+                                    max_length=self.config["max_seq_length"],
+                                    return_tensors="np")
+            feed = {name: inputs[name].astype(np.int64) for name in
+                    self.config["input_names"]}
+            hidden = self.session.run(["last_hidden_state"], feed)[0]
+            sorted_vecs.append(self._pool(hidden, inputs["attention_mask"]))
+
+        sorted_vecs = np.concatenate(sorted_vecs).astype(np.float32)
+        if self.config["normalize"]:
+            sorted_vecs /= np.linalg.norm(sorted_vecs, axis=-1, keepdims=True)
+        vecs = np.empty_like(sorted_vecs)
+        vecs[order] = sorted_vecs
+        return vecs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export an int8 quantized ONNX version of an embedding "
+        "model")
+    parser.add_argument("--model-name", type=str,
+                        default="sentence-transformers/all-mpnet-base-v2")
+    parser.add_argument("--output-dir", type=str, required=True)
+    args = parser.parse_args()
+    export_quantized(args.model_name, args.output_dir)
@@ -0,0 +1,162 @@
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+from dataclasses import dataclass
+
+import queue
+import threading
+import time
+
+
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    """Throughput counters for a single pipeline stage
+    Attributes:
+        name: Name of the stage
+        batches: Number of batches the stage has finished
+        rows: Number of rows in those batches
+        busy: Seconds spent doing the stage's work
+        starved: Seconds spent waiting on the previous stage
+        blocked: Seconds spent waiting on the next stage to make room
+    """
+    name: str
+    batches: int = 0
+    rows: int = 0
+    busy: float = 0.
+    starved: float = 0.
+    blocked: float = 0.
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.busy if self.busy > 0 else float("inf")
+
+    def __str__(self):
+        return f"{self.name:>10}: {self.batches} batches, {self.rows} rows, "\
+            f"{self.rows_per_second:.1f} rows/s busy, {self.busy:.1f}s busy, "\
+            f"{self.starved:.1f}s starved, {self.blocked:.1f}s blocked"
+
+
+class _Stage(threading.Thread):
+
+    def __init__(self, name: str, func: Optional[Callable[[Any], Any]],
+                 in_queue: Optional[queue.Queue], out_queue:
+                 Optional[queue.Queue], stop: threading.Event,
+                 count: Callable[[Any], int], source: Optional[Iterable] =
+                 None):
+        super().__init__(name=name, daemon=True)
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.stop = stop
+        self.count = count
+        self.source = source
+        self.stats = StageStats(name)
+        self.error = None
+
+    def _get(self):
+        t = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                item = self.in_queue.get(timeout=0.1)
+                self.stats.starved += time.perf_counter() - t
+                return item
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _put(self, item) -> bool:
+        if self.out_queue is None:
+            return True
+        t = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                self.out_queue.put(item, timeout=0.1)
+                self.stats.blocked += time.perf_counter() - t
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _items(self):
+        if self.source is not None:
+            iterator = iter(self.source)
+            while not self.stop.is_set():
+                t = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.stats.busy += time.perf_counter() - t
+                yield item
+        else:
+            while True:
+                item = self._get()
+                if item is _DONE:
+                    return
+                yield item
+
+    def run(self):
+        try:
+            for item in self._items():
+                if self.func is not None:
+                    t = time.perf_counter()
+                    item = self.func(item)
+                    self.stats.busy += time.perf_counter() - t
+                self.stats.batches += 1
+                self.stats.rows += self.count(item)
+                if not self._put(item):
+                    return
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+        finally:
+            if not self.stop.is_set():
+                self._put(_DONE)
+
+
+class StagedPipeline:
+
+    def __init__(self, source: Tuple[str, Iterable], stages: List[Tuple[str,
+                 Callable[[Any], Any]]], max_queue_size: int = 2,
+                 count: Callable[[Any], int] = lambda item: 1):
+        """Runs a source and a chain of stages each in their own thread,
+        connected by bounded queues so a slow stage applies backpressure to
+        the stages before it
+        Args:
+            source: Name of the first stage and an iterable producing its
+                batches
+            stages: Name and function of each following stage. Each function
+                takes the previous stage's output for a batch and returns the
+                input for the next stage
+            max_queue_size: Max number of batches waiting between two stages
+            count: Number of rows in a batch, used for throughput stats
+        """
+        self.source = source
+        self.stages = stages
+        self.max_queue_size = max_queue_size
+        self.count = count
+
+    def run(self) -> List[StageStats]:
+        """Run every batch through all stages, raising the first error hit
+        by any stage"""
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.max_queue_size) for _ in
+                  self.stages]
+        name, source = self.source
+        threads = [_Stage(name, None, None, queues[0], stop, self.count,
+                          source=source)]
+        for i, (name, func) in enumerate(self.stages):
+            out_queue = queues[i+1] if i+1 < len(queues) else None
+            threads.append(_Stage(name, func, queues[i], out_queue, stop,
+                                  self.count))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for thread in threads:
+            if thread.error is not None:
+                raise thread.error
+        return [thread.stats for thread in threads]
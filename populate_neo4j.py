@@ -1,52 +1,185 @@
 from entity_resolution import EntityResolution
 from neo4j_connection import Neo4jConnection
 from data_structures import Entity, Relationship
-from data_structures.key import TableDataKey
+from data_structures.key import TableDataKey, KeyBatch
 from langchain_community.vectorstores import Neo4jVector
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.embeddings import HuggingFaceEmbeddings
 
 from embedding import EntityEmbedder
+from embedding_cache import EmbeddingCache
+from embedding_workers import EmbeddingWorkerPool
+from onnx_embedding import OnnxEncoder
+from pipeline_stages import StagedPipeline
+from entity_dedup import EntityDeduplicator, DedupPlan
+from identity_index import IdentityIndex
+from blocking import Blocker
+from cluster_collapse import collapse_plan
+from identity_edges import MERGE_EDGE, CANONICALIZE, canonicalize
+from graph_schema import (
+    entity_label, vector_index_name, label_entities, set_entity_labels,
+    create_vector_indexes, create_schema, check_index_seeks
+)
+from neighbor_scores import NeighborScorer
+from ingest_checkpoint import IngestCheckpoint, ordered_query
+from row_fingerprints import RowFingerprints, RowIds
+from bulk_export import BulkExporter
+from file_source import read_file_batches
 
-from typing import Optional, List
-from dataclasses import asdict
+from typing import Dict, Optional, List, Iterator
+from dataclasses import dataclass, asdict
+from functools import partial
+from hashlib import md5
 import numpy as np
 import pickle
 import pandas as pd
 import streamlit as st
 import neo4j
+import os
 import time
+import random
 import argparse
+import threading
+
+
+@dataclass
+class IngestBatch:
+    """A batch of rows as it moves through the ingest steps"""
+    df: pd.DataFrame
+    min_idx: int
+    # Content derived id of each row, indexed like df
+    row_ids: Optional[pd.Series] = None
+    batch_seq: Optional[int] = None
+    key_batch: Optional[KeyBatch] = None
+    dedup: Optional[DedupPlan] = None
+    embed_idxs: Optional[np.ndarray] = None
+    embeddings: Optional[List[np.array]] = None
+    entity_ids: Optional[List[str]] = None
+    written_idxs: Optional[np.ndarray] = None
+    written_ids: Optional[List[str]] = None
+    written_embeddings: Optional[List[np.array]] = None
+
+    @property
+    def num_rows(self) -> int:
+        return self.df.shape[0]
 
 
 class GraphDBPipeline:
 
-    def __init__(self, vector_db: Neo4jVector, snowflake_conn,
-                 test: bool=False, max_retries: int = 8):
+    def __init__(self, vector_db: Optional[Neo4jVector], snowflake_conn,
+                 test: bool=False, max_retries: int = 8,
+                 base_backoff: float = 0.5, max_backoff: float = 30.0,
+                 embedding: Optional[EntityEmbedder] = None):
         """Class to handle populating graph db from a snowflake table including
         basic entity recognition
         Args:
-            vector_db: Neo4jVector instance connecting to target graph db
+            vector_db: Neo4jVector instance connecting to target graph db.
+                None when only bulk exporting, which never touches the graph
+                db
             snowflake_conn: Snowflake connection to pull table form
-            max_retries: Max number of retries upon SessionExpired erros
+            max_retries: Max number of retries of a write step upon transient
+                errors
+            base_backoff: Upper bound in seconds of the random wait before
+                the first retry, doubled for each further retry
+            max_backoff: Cap in seconds on the wait between retries
+            embedding: Embedder to use when there's no vector_db
         """
         self.vector_db = vector_db
+        self.embedding = embedding if vector_db is None else \
+            vector_db.embedding
+        self.neo4j_conn = None
+        if vector_db is not None:
+            # Shares the vector store's driver and connection pool
+            self.neo4j_conn = Neo4jConnection(driver=vector_db._driver,
+                                              database=vector_db._database)
         self.snowflake_conn = snowflake_conn
         self.test = test
         self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
         self.neo4j_url = st.secrets.neo4j.uri
         self.username = "neo4j"
         self.pwd = st.secrets.neo4j.pwd
+        # Nodes whose Contribution edges changed this run
+        self.touched_ids = set()
+        self._touched_lock = threading.Lock()
+        self._batches_done = 0
+
+
+    def bootstrap(self, entity_types: List[str]):
+        """Create the constraints and indexes the ingest queries use, label
+        existing nodes by entity type, create a vector index per entity type
+        for identity search and check the ingest queries seek nodes through
+        them"""
+        # Stored embeddings are the name and description vectors
+        # concatenated, so they're twice as long as the model's
+        dimensions = len(self.embedding.embed_documents(["x"])[0])
+        with self.neo4j_conn.session() as session:
+            create_schema(session)
+            label_entities(session, entity_types)
+            create_vector_indexes(session, entity_types,
+                                  dimensions=dimensions)
+            scans = check_index_seeks(session, self._ingest_queries(
+                entity_types))
+        for name, operators in scans.items():
+            print(f"Warning: {name} query plan uses {', '.join(operators)} "
+                  "instead of an index seek")
 
+    def _ingest_queries(self, entity_types: List[str]) -> dict:
+        """The queries run for every batch, with example parameters"""
+        ids = {"ids": ["0"]}
+        queries = {
+            "existing ids": (self.EXISTING_IDS_QUERY, ids),
+            "merged ids": (self.MERGED_IDS_QUERY, ids),
+            "relationships": (self._relationship_query(["amount"]),
+                              {"data": [{"amount": 0, "rel_id": "0",
+                                         "source": "0", "terminal": "0"}]}),
+            "identity edges": (self.WRITE_IDENTITY_EDGES_QUERY,
+                               {"pairs": [{"source": "0", "target": "1",
+                                           "score": 1.0,
+                                           "name_score": 1.0}]}),
+            "collapse": (self.COLLAPSE_EDGES_QUERY,
+                         {"batch_seq": 0, "score_min": 0.988,
+                          "name_score_min": 0.988}),
+            "clean up": (CANONICALIZE, {"batch_seq": 0,
+                                        "entity_ids": ["0"]}),
+            "neighbor score": (self.NEIGHBOR_SCORE_FOR_QUERY, ids),
+        }
+        for entity_type in entity_types:
+            queries[f"{entity_type} identity candidates"] = (
+                self.identity_candidates_query(entity_type),
+                {"batch_seq": 0})
+        return queries
 
-    def _get_min_id(self) -> int:
-        maxid = self.vector_db.query("MATCH (n) RETURN MAX(ID(n)) as max;")[0]["max"] or -1
-        return maxid+1
+    def _next_batch_seq(self) -> int:
+        """Advance the batch watermark kept on the graph's IngestState node
+        and return it. Every node written by a batch is stamped with its
+        batch_seq, so the batch's nodes can be found through an index.
+        The watermark is advanced in its own transaction ahead of the node
+        write, so a batch whose write fails for good leaves a gap: seqs only
+        increase and are unique, they aren't contiguous"""
+        query = "MERGE (s:IngestState {name: 'watermark'}) "\
+            "SET s.batch_seq = coalesce(s.batch_seq, 0) + 1 "\
+            "RETURN s.batch_seq AS batch_seq"
+        return self.neo4j_conn.execute_write(
+            lambda tx: tx.run(query).single()["batch_seq"])
 
     def process_snowflake_table(self, data_key: TableDataKey,
                                 csv_file: Optional[str] = None, row_index: int
                                 = 0, max_batch_size=500,
-                                relationship_type="contribution"):
+                                relationship_type="contribution",
+                                columnar: bool = True,
+                                reject_file: Optional[str] = None,
+                                pipelined: bool = False,
+                                max_queue_size: int = 2,
+                                dedup: bool = True,
+                                identity_index: Optional[IdentityIndex] = None,
+                                neighbor_score: str = "incremental",
+                                neighbor_score_batch_size: int = 1000,
+                                checkpoint: Optional[IngestCheckpoint] = None,
+                                fingerprints: Optional[RowFingerprints] = None,
+                                save_every: int = 20,
+                                exporter: Optional[BulkExporter] = None):
         """
         Args:
             data_key: TableDataKey instance with instructions for extracting
@@ -54,176 +187,727 @@ class GraphDBPipeline:
                 file
             query: Snowflake query whose results are to be upserted into graph
                 db. Either query or csv_file must be provided
-            csv_file: csv file path containing data to be upserted into graph
-                db. Either csv_file or query must be provided
+            csv_file: csv or Parquet file path containing data to be upserted
+                into graph db, streamed in chunks. Either csv_file or query
+                must be provided
             row_index: Row index to start the upsert at. Allows upserts that
-                crashed to be continued. Only works if using csv_file!
+                crashed to be continued. Snowflake query results are sorted
+                by data_key.order_by so their row indices are stable
             max_batch_size: Max size of each dataframe to be processed
+            columnar: Extract entities a whole batch at a time with
+                `TableDataKey.build_frame`. If False fall back to building
+                each row separately
+            reject_file: csv file path rows whose entity types couldn't be
+                resolved are appended to
+            pipelined: Run fetching, building, dedup, embedding and graph
+                writes concurrently, each stage in its own thread. A batch's
+                node, edge and identity writes make up one stage
+            max_queue_size: Max number of batches waiting between two stages
+                when pipelined
+            dedup: Only create one node per distinct entity key, pointing the
+                relationships of exact duplicates at that node instead
+            identity_index: If given, find identity edge candidates with this
+                in process ANN index instead of the database's vector index.
+                New nodes are added to it as they are written
+            neighbor_score: "incremental" only rescores identity edges of nodes
+                whose Contribution edges changed this run, "full" rescores
+                every identity edge in the graph in one transaction and
+                "sparse" rescores every identity edge with NeighborScorer
+            neighbor_score_batch_size: Number of touched nodes rescored per
+                transaction in incremental mode
+            checkpoint: If given, the row index up to which the table has
+                been ingested is committed to it after each batch
+            fingerprints: If given, rows ingested before and unchanged since
+                are skipped, and the rows ingested are added to it
+            save_every: Number of batches between saves of fingerprints
+            exporter: If given, write nodes and relationships to offline
+                import files with it instead of the graph db, which isn't
+                read either. Identity edges and neighbor scores are left to
+                `post_import`
         """
+        if neighbor_score not in ["incremental", "full", "sparse"]:
+            raise ValueError(f"Unknown neighbor score mode {neighbor_score}")
+        self.touched_ids = set()
+        self._batches_done = 0
+        if exporter is None:
+            self.bootstrap(sorted(data_key.entity_types))
+        deduplicator = EntityDeduplicator() if dedup else None
+        batches = self._fetch_batches(data_key, csv_file, row_index,
+                                      max_batch_size,
+                                      fingerprints=fingerprints,
+                                      row_ids=RowIds(data_key.columns,
+                                                     data_key.row_key))
+        build = partial(self._build_batch, data_key, columnar=columnar,
+                        reject_file=reject_file)
+        write_edges = partial(self._write_edges,
+                              table_name=data_key.table_name,
+                              relationship_type=relationship_type)
+        resolve = partial(self._resolve_batch, data_key,
+                          identity_index=identity_index,
+                          checkpoint=checkpoint, fingerprints=fingerprints,
+                          deduplicator=deduplicator, save_every=save_every)
+        dedup_batch = partial(self._dedup_batch, deduplicator)
+        write_nodes = partial(self._write_nodes, deduplicator=deduplicator)
+        export = partial(self._export_batch, exporter=exporter,
+                         deduplicator=deduplicator,
+                         table_name=data_key.table_name,
+                         relationship_type=relationship_type,
+                         fingerprints=fingerprints)
+
+        if exporter is not None:
+            steps = [("build", build), ("dedup", dedup_batch),
+                     ("embed", self._embed_batch), ("export", export)]
+            if pipelined:
+                stats = StagedPipeline(
+                    ("fetch", batches), steps,
+                    max_queue_size=max_queue_size,
+                    count=lambda batch: batch.num_rows).run()
+                for stage_stats in stats:
+                    print(stage_stats)
+            else:
+                for batch in batches:
+                    for _, step in steps:
+                        batch = step(batch)
+            exporter.close()
+            print(exporter)
+            print(exporter.import_command() if self.neo4j_conn is None else
+                  exporter.import_command(self.neo4j_conn.database))
+        elif pipelined:
+            # Collapsing merges nodes that the node and edge writers of later
+            # batches could be matching on, so a batch's node, edge and
+            # identity writes run as one stage and are finished before the
+            # next batch's start
+            def write_graph(batch):
+                return resolve(write_edges(write_nodes(batch)))
+
+            stats = StagedPipeline(
+                ("fetch", batches),
+                [("build", build), ("dedup", dedup_batch),
+                 ("embed", self._embed_batch),
+                 ("graph", write_graph)],
+                max_queue_size=max_queue_size,
+                count=lambda batch: batch.num_rows).run()
+            for stage_stats in stats:
+                print(stage_stats)
+        else:
+            for batch in batches:
+                batch = build(batch)
+                batch = dedup_batch(batch)
+                batch = self._embed_batch(batch)
+                batch = write_nodes(batch)
+                batch = write_edges(batch)
+                resolve(batch)
+
+        if exporter is None:
+            self._retry(self._score_neighbors, neighbor_score,
+                        neighbor_score_batch_size)
+        if self.neo4j_conn is not None:
+            self.neo4j_conn.close()
+
+        for slot, count in sorted(data_key.reject_counts.items()):
+            print(f"Rejected {count} rows with unresolved type for entity {slot}")
+        if deduplicator is not None:
+            print(deduplicator)
+        if fingerprints is not None:
+            fingerprints.save()
+            print(fingerprints)
+
+    def _fetch_batches(self, data_key: TableDataKey, csv_file: Optional[str],
+                       row_index: int, max_batch_size: int,
+                       fingerprints: Optional[RowFingerprints] = None,
+                       row_ids: Optional[RowIds] = None
+                       ) -> Iterator[IngestBatch]:
+        """Yield the table's rows in dataframes no bigger than max_batch_size,
+        leaving out rows fingerprints has seen before. Rows are read as
+        Arrow record batches, and each dataframe is converted from a zero
+        copy slice of one. Row ids are taken before rows are left out, so
+        skipped rows still count towards the ids of identical rows"""
         if csv_file is not None:
-            query_res = pd.read_csv(csv_file).replace({np.nan: None})
-            query_res = [query_res.iloc[row_index:]]
+            query_res = read_file_batches(csv_file, row_index=row_index)
         else:
             cursor = self.snowflake_conn.cursor()
-            query = data_key.query
-            if query is None:
-                query = f"select * from {data_key.table_name}"
-            query_res = cursor.execute(query).fetch_pandas_batches()
+            query = ordered_query(self.table_query(data_key),
+                                  data_key.order_by, offset=row_index)
+            query_res = cursor.execute(query).fetch_arrow_batches()
 
-        scores_all = []
-        entity_strings_all = []
+        offset = row_index
         for batch_res in query_res:
-            min_id = self._get_min_id()
-
-            # Split batch_res into dataframes no bigger than max_batch_size
-            num_batches = np.ceil(batch_res.shape[0] / float(max_batch_size)).astype(np.int32)
-            for df in np.array_split(batch_res, num_batches):
-                batch_entity_strs = []
-                entities_metadata = []
-                src_entity_idxs = []
-                term_entity_idxs = []
-                batch_relationships = []
-                min_idx = df.index[0]
-                for idx, row in df.iterrows():
-                    entities, relationships, entity_relationship_idx = \
-                        data_key.build(row, idx)
-                    num_entities = len(batch_entity_strs)
-                    src_entity_idxs += [rel[0]+num_entities for rel
-                                        in entity_relationship_idx]
-                    term_entity_idxs += [rel[1]+num_entities for rel
-                                        in entity_relationship_idx]
-                    entity_strings = list(map(lambda x: x.to_text(), entities))
-                    batch_entity_strs += entity_strings
-                    entities_metadata += list(map(asdict, entities))
-                    batch_relationships += relationships
-
-                passed = False
-                counter = 0
-                while not passed and counter < self.max_retries:
-                    try:
-                        entity_ids = self.vector_db.add_texts(batch_entity_strs,
-                                                              entities_metadata)
-                        passed = True
-                    except neo4j.exceptions.SessionExpired:
-                        time.sleep(4)
-                        self._reset_neo4j_conn()
-                        counter += 1
-                if counter >= self.max_retries:
-                    raise Exception("Reached maximum number of retries")
-
-                self.add_relationships(batch_relationships, entity_ids,
-                                       src_entity_idxs, term_entity_idxs,
-                                       relationship_type=relationship_type)
-                self.process_batch(min_idx, data_key)
+            # Index rows by their position in the ordered results
+            index = pd.RangeIndex(offset, offset+batch_res.num_rows)
+            offset += batch_res.num_rows
+            if fingerprints is None:
+                for start in range(0, batch_res.num_rows, max_batch_size):
+                    df = self._to_frame(
+                        batch_res.slice(start, max_batch_size),
+                        index[start:start+max_batch_size],
+                        nulls_to_none=csv_file is not None)
+                    yield IngestBatch(df=df, min_idx=df.index[0],
+                                      row_ids=self._row_ids(row_ids, df))
+                continue
+
+            # Rows are hashed before they're batched so skipped rows don't
+            # leave batches short
+            df = self._to_frame(batch_res, index,
+                                nulls_to_none=csv_file is not None)
+            ids = self._row_ids(row_ids, df)
+            keep = fingerprints.split(df)
+            df = df[keep]
+            if ids is not None:
+                ids = ids[keep]
+            for start in range(0, df.shape[0], max_batch_size):
+                batch_df = df.iloc[start:start+max_batch_size]
+                yield IngestBatch(df=batch_df, min_idx=batch_df.index[0],
+                                  row_ids=None if ids is None else
+                                  ids.iloc[start:start+max_batch_size])
+
+    @staticmethod
+    def _row_ids(row_ids: Optional[RowIds], df: pd.DataFrame
+                 ) -> Optional[pd.Series]:
+        if row_ids is None:
+            return None
+        return pd.Series(row_ids(df), index=df.index, dtype=object)
+
+    @staticmethod
+    def _to_frame(batch_res, index: pd.RangeIndex,
+                  nulls_to_none: bool = False) -> pd.DataFrame:
+        """Convert an Arrow table or record batch to a dataframe with the
+        given index"""
+        df = batch_res.to_pandas()
+        df.index = index
+        if nulls_to_none:
+            df = df.replace({np.nan: None})
+        return df
+
+    @staticmethod
+    def table_query(data_key: TableDataKey) -> str:
+        query = data_key.query
+        if query is None:
+            query = f"select * from {data_key.table_name}"
+        return query
+
+    def _build_batch(self, data_key: TableDataKey, batch: IngestBatch,
+                     columnar: bool = True, reject_file: Optional[str] = None
+                     ) -> IngestBatch:
+        if columnar:
+            batch.key_batch = data_key.build_frame(batch.df)
+            self._write_rejects(batch.key_batch.rejected, reject_file)
+        else:
+            batch.key_batch = data_key.build_rows(batch.df)
+        return batch
+
+    @staticmethod
+    def _dedup_batch(deduplicator: Optional[EntityDeduplicator],
+                     batch: IngestBatch) -> IngestBatch:
+        if deduplicator is not None:
+            batch.dedup = deduplicator.plan(batch.key_batch.entity_keys)
+        return batch
+
+    def _embed_batch(self, batch: IngestBatch) -> IngestBatch:
+        if batch.dedup is None:
+            batch.embed_idxs = np.arange(len(batch.key_batch))
+        else:
+            batch.embed_idxs = batch.dedup.write_idxs.copy()
+        texts = batch.key_batch.entity_texts
+        batch.embeddings = self.embedding.embed_documents(
+            [texts[i] for i in batch.embed_idxs])
+        return batch
+
+    def _embeddings_for(self, batch: IngestBatch, idxs: np.ndarray
+                        ) -> List[np.array]:
+        """Embeddings of the given entities, embedding any the embed step
+        skipped"""
+        positions = dict(zip(batch.embed_idxs, range(len(batch.embed_idxs))))
+        missing = [i for i in idxs if i not in positions]
+        if len(missing):
+            texts = batch.key_batch.entity_texts
+            extra = self.embedding.embed_documents(
+                [texts[i] for i in missing])
+            positions.update({i: len(batch.embeddings) + j for j, i in
+                              enumerate(missing)})
+            batch.embeddings = list(batch.embeddings) + list(extra)
+            batch.embed_idxs = np.concatenate([batch.embed_idxs, missing])
+        return [batch.embeddings[positions[i]] for i in idxs]
+
+    EXISTING_IDS_QUERY = "UNWIND $ids AS id "\
+        "MATCH (n:Entity {entity_id: id}) "\
+        "RETURN DISTINCT id"
+
+    def _existing_ids(self, ids: List[str]) -> set:
+        return {row["id"] for row in self.neo4j_conn.query(
+            self.EXISTING_IDS_QUERY, {"ids": ids})}
+
+    MERGED_IDS_QUERY = "UNWIND $ids AS id "\
+        "MATCH (m:MergedEntity {entity_id: id}) "\
+        "RETURN id, m.into AS into"
+
+    def _merged_into(self, ids: List[str]) -> Dict[str, str]:
+        """Entity id of the node each of the given ids' nodes was merged
+        into, for those that were"""
+        return {row["id"]: row["into"] for row in self.neo4j_conn.query(
+            self.MERGED_IDS_QUERY, {"ids": ids})}
+
+    @staticmethod
+    def _node_rows(batch: IngestBatch, write_idxs: np.ndarray) -> tuple:
+        """Texts, ids and metadata of the nodes written for a batch"""
+        texts = [batch.key_batch.entity_texts[i] for i in write_idxs]
+        # Same ids add_embeddings would generate, also stored as entity_id
+        # which the pipeline matches nodes on
+        entity_ids = [md5(text.encode("utf-8")).hexdigest() for text in texts]
+        metadata = batch.key_batch.entities_metadata
+        written_metadata = [{**metadata[i], "id": entity_id,
+                             "entity_id": entity_id} for i, entity_id in
+                            zip(write_idxs, entity_ids)]
+        return texts, entity_ids, written_metadata
+
+    def _write_nodes(self, batch: IngestBatch,
+                     deduplicator: Optional[EntityDeduplicator] = None
+                     ) -> IngestBatch:
+        plan = batch.dedup
+        if plan is None:
+            write_idxs = np.arange(len(batch.key_batch))
+        else:
+            # Pick up entities written by batches that were in flight when
+            # the plan was made and nodes merged by collapse_clusters since,
+            # then drop any earlier nodes that no longer exist
+            deduplicator.refresh(plan)
+            known_ids = list(set(plan.known.values()))
+            if len(known_ids):
+                missing_ids = set(known_ids) - self._retry(self._existing_ids,
+                                                           known_ids)
+                deduplicator.forget(plan, missing_ids)
+            write_idxs = plan.write_idxs
+
+        texts, entity_ids, written_metadata = self._node_rows(batch,
+                                                             write_idxs)
+        # Entities whose nodes were collapsed into another node, e.g. when
+        # rows are written again, are pointed at the surviving node instead
+        # of bringing the merged away node back
+        merged = self._retry(self._merged_into, entity_ids) if \
+            len(entity_ids) else {}
+        node_ids = [merged.get(entity_id, entity_id) for entity_id in
+                    entity_ids]
+        if len(merged):
+            keep = [j for j, entity_id in enumerate(entity_ids) if entity_id
+                    not in merged]
+            write_idxs = write_idxs[keep]
+            texts = [texts[j] for j in keep]
+            entity_ids = [entity_ids[j] for j in keep]
+            written_metadata = [written_metadata[j] for j in keep]
+        metadata = batch.key_batch.entities_metadata
+        embeddings = self._embeddings_for(batch, write_idxs)
+        batch.batch_seq = self._retry(self._next_batch_seq)
+        for entity_dict in written_metadata:
+            entity_dict["batch_seq"] = batch.batch_seq
+        # Nodes are merged on their ids, so a write that failed part way
+        # through can be repeated
+        self._retry(lambda: self.vector_db.add_embeddings(
+            texts=texts, embeddings=embeddings, metadatas=written_metadata,
+            ids=entity_ids))
+        self._retry(lambda: self.neo4j_conn.execute_write(
+            set_entity_labels, entity_ids,
+            [metadata[i]["entity_type"] for i in write_idxs]))
+
+        if plan is None:
+            batch.entity_ids = node_ids
+        else:
+            batch.entity_ids = deduplicator.commit(plan, node_ids)
+        batch.written_idxs = write_idxs
+        batch.written_ids = entity_ids
+        batch.written_embeddings = embeddings
+        return batch
+
+    def _write_edges(self, batch: IngestBatch, table_name: str,
+                     relationship_type: str = "contribution") -> IngestBatch:
+        self._retry(self.add_relationships, batch.key_batch.relationships,
+                    batch.entity_ids, batch.key_batch.src_entity_idxs,
+                    batch.key_batch.term_entity_idxs, table_name,
+                    relationship_type=relationship_type,
+                    row_ids=batch.row_ids)
+        entity_ids = np.array(batch.entity_ids)
+        self._touch(entity_ids[batch.key_batch.src_entity_idxs])
+        self._touch(entity_ids[batch.key_batch.term_entity_idxs])
+        return batch
+
+    def _export_batch(self, batch: IngestBatch, exporter: BulkExporter,
+                      deduplicator: Optional[EntityDeduplicator] = None,
+                      table_name: str = "",
+                      relationship_type: str = "contribution",
+                      fingerprints: Optional[RowFingerprints] = None
+                      ) -> IngestBatch:
+        """Write a batch's nodes and relationships to the bulk import files
+        instead of the graph db"""
+        plan = batch.dedup
+        if plan is None:
+            write_idxs = np.arange(len(batch.key_batch))
+        else:
+            # Nothing is merged before the import, so entities written by
+            # earlier batches are never missing
+            deduplicator.refresh(plan)
+            write_idxs = plan.write_idxs
+        texts, entity_ids, written_metadata = self._node_rows(batch,
+                                                             write_idxs)
+        exporter.write_nodes(entity_ids, texts, written_metadata,
+                             self._embeddings_for(batch, write_idxs))
+        batch.batch_seq = exporter.batch_seq
+        if plan is None:
+            batch.entity_ids = entity_ids
+        else:
+            batch.entity_ids = deduplicator.commit(plan, entity_ids)
+        if batch.key_batch.relationships.shape[0]:
+            exporter.write_relationships(self._relationships_to_df(
+                batch.key_batch.relationships, batch.entity_ids,
+                batch.key_batch.src_entity_idxs,
+                batch.key_batch.term_entity_idxs, table_name,
+                row_ids=batch.row_ids),
+                relationship_type)
+        if fingerprints is not None:
+            fingerprints.record(batch.df)
+        return batch
 
-        with self.vector_db._driver.session(database=self.vector_db._database) as session:
-            session.execute_write(self.assign_neighbor_score)
-        self.vector_db._driver.close()
+    def post_import(self, data_key: TableDataKey,
+                    identity_index: Optional[IdentityIndex] = None,
+                    neighbor_score: str = "sparse"):
+        """Identity resolution for a graph loaded from bulk export files.
+        Creates the schema and indexes, then adds identity edges and collapses
+        clusters for each exported batch in turn, as the ingest would have
+        done after writing it
+        Args:
+            data_key: TableDataKey the files were exported with
+            identity_index: If given, find identity edge candidates with this
+                in process ANN index, loaded with `load_identity_index`,
+                instead of the database's vector index
+            neighbor_score: "full" or "sparse" scoring of every identity
+                edge once the batches are resolved
+        """
+        if neighbor_score not in ["full", "sparse"]:
+            raise ValueError(f"Unknown neighbor score mode {neighbor_score}")
+        self.touched_ids = set()
+        self.bootstrap(sorted(data_key.entity_types))
+        query = "MATCH (s:IngestState {name: 'watermark'}) "\
+            "RETURN s.batch_seq AS batch_seq"
+        res = self.neo4j_conn.query(query)
+        num_batches = res[0]["batch_seq"] if len(res) else 0
+        for batch_seq in range(1, num_batches + 1):
+            identity_pairs = None
+            if identity_index is not None:
+                query = "MATCH (n:Entity) WHERE n.batch_seq = $batch_seq "\
+                    "RETURN n.entity_id AS id, n.embedding AS embedding, "\
+                    "n.entity_type AS entity_type, n.suffix AS suffix, "\
+                    "n.gender AS gender"
+                rows = self.neo4j_conn.query(query, {"batch_seq": batch_seq})
+                if len(rows):
+                    identity_pairs = identity_index.candidate_pairs(
+                        [row["id"] for row in rows],
+                        np.array([row["embedding"] for row in rows]), rows)
+            self._retry(self.process_batch, batch_seq, data_key,
+                        identity_pairs=identity_pairs)
+            print(f"Resolved batch {batch_seq}/{num_batches}")
+
+        self._retry(self._score_neighbors, neighbor_score)
+        self.neo4j_conn.close()
+
+    def _score_neighbors(self, neighbor_score: str, batch_size: int = 1000):
+        if neighbor_score == "incremental":
+            self.assign_neighbor_score_incremental(list(self.touched_ids),
+                                                   batch_size=batch_size)
+        elif neighbor_score == "sparse":
+            NeighborScorer(self.neo4j_conn).run()
+        else:
+            self.neo4j_conn.execute_write(self.assign_neighbor_score)
 
+    def _touch(self, entity_ids):
+        with self._touched_lock:
+            self.touched_ids.update(entity_ids)
+
+    def _resolve_batch(self, data_key: TableDataKey, batch: IngestBatch,
+                       identity_index: Optional[IdentityIndex] = None,
+                       checkpoint: Optional[IngestCheckpoint] = None,
+                       fingerprints: Optional[RowFingerprints] = None,
+                       deduplicator: Optional[EntityDeduplicator] = None,
+                       save_every: int = 20) -> IngestBatch:
+        identity_pairs = None
+        if identity_index is not None:
+            metadata = batch.key_batch.entities_metadata
+            written_metadata = [metadata[i] for i in batch.written_idxs]
+            identity_index.add(batch.written_ids, batch.written_embeddings,
+                               written_metadata)
+            identity_pairs = identity_index.candidate_pairs(
+                batch.written_ids, batch.written_embeddings, written_metadata)
+        merged = self._retry(self.process_batch, batch.batch_seq, data_key,
+                             identity_pairs=identity_pairs)
+        if deduplicator is not None:
+            deduplicator.remap(merged)
+        if identity_index is not None:
+            identity_index.remove(list(merged))
+        if fingerprints is not None:
+            fingerprints.record(batch.df)
+            self._batches_done += 1
+            if self._batches_done % save_every == 0:
+                fingerprints.save()
+        if checkpoint is not None:
+            # Batches reach this step in order, so every earlier row is done.
+            # The index holds each row's position in the table
+            checkpoint.commit(int(batch.df.index[-1]) + 1)
+        return batch
+
+    def load_identity_index(self, identity_index: IdentityIndex,
+                            batch_size: int = 10000):
+        """Add every entity already in the graph to identity_index"""
+        query = "MATCH (n:Entity) WHERE n.embedding IS NOT NULL "\
+            "RETURN n.entity_id AS id, n.embedding AS embedding, "\
+            "n.entity_type AS entity_type, n.suffix AS suffix, "\
+            "n.gender AS gender"
+        with self.neo4j_conn.session() as session:
+            rows = []
+            for record in session.run(query):
+                rows.append(record.data())
+                if len(rows) >= batch_size:
+                    self._add_to_identity_index(identity_index, rows)
+                    rows = []
+            self._add_to_identity_index(identity_index, rows)
+
+    @staticmethod
+    def _add_to_identity_index(identity_index: IdentityIndex,
+                               rows: List[dict]):
+        if len(rows) == 0:
+            return
+        identity_index.add([row["id"] for row in rows],
+                           np.array([row["embedding"] for row in rows]),
+                           rows)
+
+    @staticmethod
+    def _write_rejects(rejected: pd.DataFrame, reject_file: Optional[str]):
+        if reject_file is None or rejected.shape[0] == 0:
+            return
+        rejected.to_csv(reject_file, mode="a",
+                        header=not os.path.exists(reject_file))
+
+    def _retry(self, func, *args, **kwargs):
+        """Run a graph db write step, retrying transient errors and lost
+        connections with exponential backoff and full jitter. Every step is
+        idempotent, so one that failed after committing part of its work can
+        be run again"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except (neo4j.exceptions.Neo4jError,
+                    neo4j.exceptions.DriverError) as error:
+                if not error.is_retryable() or attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.max_backoff,
+                                              self.base_backoff * 2 ** attempt))
+                print(f"{type(error).__name__}, retry {attempt + 1} of "
+                      f"{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+                if isinstance(error, (neo4j.exceptions.SessionExpired,
+                                      neo4j.exceptions.ServiceUnavailable)):
+                    self._reset_neo4j_conn()
 
     def _reset_neo4j_conn(self):
         self.vector_db._driver = neo4j.GraphDatabase.driver(self.neo4j_url,
                                                             auth=(self.username,
                                                              self.pwd))
+        self.neo4j_conn = Neo4jConnection(driver=self.vector_db._driver,
+                                          database=self.vector_db._database)
+
+    @staticmethod
+    def relationship_ids(table_name: str, relationships: pd.DataFrame,
+                         row_ids: Optional[pd.Series] = None) -> np.ndarray:
+        """Deterministic id of each relationship from its table, row and
+        position among the row's relationships in the key, so writing a
+        row's relationships again matches the ones already written. Rows
+        are identified by row_ids, their content derived ids, falling back
+        to their position in the table, which changes when rows are added
+        before them"""
+        slots = relationships.groupby("row_index", sort=False).cumcount()
+        rows = relationships["row_index"].astype(str) if row_ids is None \
+            else pd.Series(row_ids.loc[relationships["row_index"]].to_numpy(),
+                           index=relationships.index, dtype=object)
+        keys = table_name + "\x1f" + rows + "\x1f" + slots.astype(str)
+        return np.array([md5(key.encode("utf-8")).hexdigest() for key in
+                         keys], dtype=object)
 
-    def _relationships_to_df(self, relationships: List[Relationship],
-                             entity_ids: List[str], src_entity_idxs: List[int],
-                             term_entity_idxs: List[int]) -> pd.DataFrame:
-        src_ids = np.array(entity_ids)[src_entity_idxs]
-        term_ids = np.array(entity_ids)[term_entity_idxs]
-        df = pd.DataFrame([asdict(rel) for rel in relationships])
-        df["source"] = src_ids
-        df["terminal"] = term_ids
+    def _relationships_to_df(self, relationships: pd.DataFrame,
+                             entity_ids: List[str], src_entity_idxs: np.ndarray,
+                             term_entity_idxs: np.ndarray,
+                             table_name: str,
+                             row_ids: Optional[pd.Series] = None
+                             ) -> pd.DataFrame:
+        df = relationships.copy()
+        df["rel_id"] = self.relationship_ids(table_name, relationships,
+                                             row_ids)
+        df["source"] = np.array(entity_ids)[src_entity_idxs]
+        df["terminal"] = np.array(entity_ids)[term_entity_idxs]
         return df
 
 
-    def add_relationships(self, relationships: List[Relationship], entity_ids:
-                          List[str], src_entity_idxs: List[int],
-                          term_entity_idxs: List[int], relationship_type: str = "Contribution"):
+    def add_relationships(self, relationships: pd.DataFrame, entity_ids:
+                          List[str], src_entity_idxs: np.ndarray,
+                          term_entity_idxs: np.ndarray, table_name: str,
+                          relationship_type: str = "Contribution",
+                          row_ids: Optional[pd.Series] = None):
+        if relationships.shape[0] == 0:
+            return
         df = self._relationships_to_df(relationships, entity_ids,
-                                       src_entity_idxs, term_entity_idxs)
+                                       src_entity_idxs, term_entity_idxs,
+                                       table_name, row_ids=row_ids)
+
+        query = self._relationship_query(
+            [column for column in df.columns if column not in
+             ["rel_id", "source", "terminal"]], relationship_type)
+        self.neo4j_conn.query(query, {"data": df.to_dict("records")})
 
+    @staticmethod
+    def _relationship_query(columns: List[str],
+                            relationship_type: str = "Contribution") -> str:
         query = "UNWIND $data AS row "\
-            "MATCH (src {entity_id: row.source}) "\
-            "MATCH (targ {entity_id: row.terminal}) "\
-            f"CREATE (src)-[rel:{relationship_type}]->(targ) "
+            "MATCH (src:Entity {entity_id: row.source}) "\
+            "MATCH (targ:Entity {entity_id: row.terminal}) "\
+            f"MERGE (src)-[rel:{relationship_type} {{rel_id: row.rel_id}}]->(targ) "
         query += "\nSET "+", ".join([f"rel.{column}=row.{column}" for
-                                           column in df.columns[:-2]])
+                                     column in columns])
+        return query
 
-        self.vector_db.query(query, params={"data": df.to_dict("records")})
 
+    def process_batch(self, batch_seq: int, data_key,
+                      identity_pairs: Optional[List[dict]] = None
+                      ) -> Dict[str, str]:
+        """Add identity edges for a batch's nodes and collapse near certain
+        identities, returning the entity id each merged away node was merged
+        into"""
+        # The batch's statements share one session
+        with self.neo4j_conn.session():
+            if identity_pairs is None:
+                self.neo4j_conn.execute_write(self.add_identity_edges,
+                                              sorted(data_key.entity_types),
+                                              batch_seq)
+            else:
+                self.neo4j_conn.execute_write(self.write_identity_edges,
+                                              identity_pairs)
 
-    def process_batch(self, min_id: int, data_key):
-        with self.vector_db._driver.session(database=self.vector_db._database) as session:
-            session.execute_write(self.add_identity_edges,
-                                  data_key.entity_types, min_id)
-
-        self.collapse_clusters(min_id)
-        with self.vector_db._driver.session(database=self.vector_db._database) as session:
-            session.execute_write(self.clean_up, min_id)
+            # Merged nodes take over the Contribution edges of the nodes
+            # merged into them
+            merged = self.collapse_clusters(batch_seq)
+            merged_ids = sorted(set(merged.values()))
+            self._touch(merged_ids)
+            self.neo4j_conn.execute_write(self.clean_up, batch_seq,
+                                          merged_ids)
+        return merged
 
     @staticmethod
-    def add_identity_edges(tx, entity_types, min_id: int, max_num_matches: int = 5,
+    def add_identity_edges(tx, entity_types, batch_seq: int, max_num_matches: int = 5,
                            threshold: int = 0.96):
         for entity_type in entity_types:
-            query = f"MATCH (n {{entity_type: '{entity_type}'}})\nWHERE n.row_index >= {min_id}\n"\
-            f"""CALL db.index.vector.queryNodes("vector", {max_num_matches}, n.embedding) YIELD node as 
+            tx.run(GraphDBPipeline.identity_candidates_query(
+                entity_type, max_num_matches, threshold), batch_seq=batch_seq)
+
+    @staticmethod
+    def identity_candidates_query(entity_type: str, max_num_matches: int = 5,
+                                  threshold: int = 0.96) -> str:
+        query = f"MATCH (n:Entity)\nWHERE n.batch_seq = $batch_seq AND n:{entity_label(entity_type)}\n"\
+            f"""CALL db.index.vector.queryNodes("{vector_index_name(entity_type)}", {max_num_matches}, n.embedding) YIELD node as 
             similar_node, score\n"""\
             f"where n.entity_type = similar_node.entity_type and n<>similar_node and score > {threshold}\n"\
             """and  (n.suffix = similar_node.suffix  OR (n.suffix is null or
             similar_node.suffix is null))\n"""\
             """and  (n.gender = similar_node.gender  OR (n.gender is null or
             similar_node.gender is null))\n"""\
-                """CREATE (n)-[rel:Identity {score: score}]->(similar_node)
-                SET rel.name_score = vector.similarity.cosine(n.embedding[0..768],
-                similar_node.embedding[0..768])"""
-            tx.run(query)
-
-    def collapse_clusters(self, min_id: int, threshold: int = 0.99):
-        merge_query = f"MATCH (n) WHERE n.row_index >= {min_id}\n"\
-        """WITH collect(n) AS nodes
-        UNWIND nodes AS node
-        CALL {
-          WITH node
-          MATCH (node)-[rel:Identity]->(connected)\n"""\
-          f"WHERE rel.score > 0.988 and rel.name_score > 0.988\n"\
-          """WITH collect(connected) AS connectedNodes, node
-          CALL apoc.refactor.mergeNodes(connectedNodes + node) YIELD node AS mergedNode
-          RETURN mergedNode
-        } IN TRANSACTIONS OF 10 ROWS
-        RETURN mergedNode"""
-        self.vector_db.query(merge_query)
+                """WITH n, similar_node AS m, score,
+                vector.similarity.cosine(n.embedding[0..768],
+                similar_node.embedding[0..768]) AS name_score"""\
+                + MERGE_EDGE
+        return query
 
     @staticmethod
-    def clean_up(tx, min_id: int):
-        consolidate_identities = """MATCH
-        (a)-[rels:Identity]->(b)\n"""\
-        f"WHERE a <> b and a.row_index >= {min_id}\n"\
-        """WITH a, b, rels
-        ORDER BY rels.score DESC
-        WITH a, b, collect(rels) AS sortedRels
-        WITH a, b, sortedRels[0] AS topRelationship, sortedRels[1..] AS
-        restOfRelationships
-        FOREACH (rel IN restOfRelationships |
-        DELETE rel
-        )
-        RETURN a, b, topRelationship"""
-
-        tx.run(consolidate_identities)
-
-        # Ensure identities are symmetric
-        symmetrize = """
-        MATCH (a)-[rel:Identity]->(b)
-        WHERE NOT (a)<-[:Identity]-(b)
-        CREATE (a)<-[newRel:Identity]-(b)
-        SET newRel = rel
+    def write_identity_edges(tx, identity_pairs: List[dict]):
+        """Create identity edges for candidate pairs found outside the
+        database"""
+        tx.run(GraphDBPipeline.WRITE_IDENTITY_EDGES_QUERY,
+               pairs=identity_pairs)
+
+    WRITE_IDENTITY_EDGES_QUERY = """UNWIND $pairs AS pair
+    MATCH (n:Entity {entity_id: pair.source})
+    MATCH (m:Entity {entity_id: pair.target})
+    WHERE n <> m
+    WITH n, m, pair.score AS score, pair.name_score AS name_score"""\
+        + MERGE_EDGE
+
+    def collapse_clusters(self, batch_seq: int, score_min: float = 0.988,
+                          name_score_min: float = 0.988,
+                          batch_size: int = 500) -> Dict[str, str]:
+        """Merge new nodes with the nodes they're near certain identities of,
+        returning the entity id of the node each merged away node was merged
+        into. Clusters are the connected
+        components of the qualifying identity edges, each merged once into
+        the node with the smallest entity_id
+        Args:
+            batch_seq: Watermark of the batch whose nodes are collapsed
+            score_min: Score above which identity edges are collapsed
+            name_score_min: Name score above which identity edges are
+                collapsed
+            batch_size: Number of clusters merged per transaction
         """
-        tx.run(symmetrize)
+        rows = self.neo4j_conn.query(self.COLLAPSE_EDGES_QUERY,
+                                     {"batch_seq": batch_seq,
+                                      "score_min": score_min,
+                                      "name_score_min": name_score_min})
+        sort_keys = {}
+        for row in rows:
+            sort_keys[row["source"]] = (row["source_id"] or "", row["source"])
+            sort_keys[row["target"]] = (row["target_id"] or "", row["target"])
+        plan = collapse_plan([(row["source"], row["target"]) for row in rows],
+                             sort_keys)
+        clusters = [{"keep": keep, "others": others} for keep, others in plan]
+
+        merged = {}
+        with self.neo4j_conn.session() as session:
+            for start in range(0, len(clusters), batch_size):
+                merged.update(session.execute_write(
+                    self.merge_clusters, clusters[start:start+batch_size]))
+        return merged
 
-        clear_self_rels = """MATCH (a) -[rel:Identity]-(a)
-        DELETE rel"""
+    COLLAPSE_EDGES_QUERY = """MATCH (n:Entity)-[rel:Identity]-(connected)
+    WHERE n.batch_seq = $batch_seq AND rel.score > $score_min
+    AND rel.name_score > $name_score_min AND n <> connected
+    RETURN elementId(n) AS source, n.entity_id AS source_id,
+    elementId(connected) AS target, connected.entity_id AS target_id"""
 
-        tx.run(clear_self_rels)
+    # Records the node each merged away node went into, also for the nodes
+    # merged into it before
+    MERGED_ENTITIES_QUERY = """UNWIND $merged AS row
+    MERGE (m:MergedEntity {entity_id: row.merged_id})
+    SET m.into = row.kept_id
+    WITH row
+    MATCH (earlier:MergedEntity {into: row.merged_id})
+    SET earlier.into = row.kept_id"""
+
+    @staticmethod
+    def merge_clusters(tx, clusters: List[dict]) -> Dict[str, str]:
+        """Merge each cluster's other nodes into its kept node, whose
+        properties win, returning the entity id of each merged away node
+        mapped to the kept node's. The mapping is also kept in the graph as
+        MergedEntity nodes"""
+        query = """UNWIND $clusters AS cluster
+        MATCH (keep) WHERE elementId(keep) = cluster.keep
+        UNWIND cluster.others AS other_id
+        MATCH (other) WHERE elementId(other) = other_id
+        WITH keep, collect(other) AS others,
+        collect(other.entity_id) AS other_ids
+        CALL apoc.refactor.mergeNodes([keep] + others, {properties: "discard"})
+        YIELD node
+        RETURN node.entity_id AS entity_id, other_ids"""
+        merged = {other_id: record["entity_id"] for record in
+                  tx.run(query, clusters=clusters) for other_id in
+                  record["other_ids"] if other_id is not None}
+        tx.run(GraphDBPipeline.MERGED_ENTITIES_QUERY,
+               merged=[{"merged_id": merged_id, "kept_id": kept_id} for
+                       merged_id, kept_id in merged.items()]).consume()
+        return merged
+
+    @staticmethod
+    def clean_up(tx, batch_seq: int, merged_ids: Optional[List[str]] = None):
+        """Leave one identity edge per pair of new or merged nodes"""
+        canonicalize(tx, batch_seq, merged_ids)
 
     @staticmethod
     def assign_neighbor_score(tx):
@@ -239,6 +923,39 @@ class GraphDBPipeline:
         """
         tx.run(query)
 
+    def assign_neighbor_score_incremental(self, entity_ids: List[str],
+                                          batch_size: int = 1000):
+        """Recompute neighbor scores only for identity edges of the given
+        nodes, committing one transaction per batch_size nodes"""
+        with self.neo4j_conn.session() as session:
+            for start in range(0, len(entity_ids), batch_size):
+                session.execute_write(self.assign_neighbor_score_for,
+                                      entity_ids[start:start+batch_size])
+
+    @staticmethod
+    def assign_neighbor_score_for(tx, entity_ids: List[str]):
+        """Same score as `assign_neighbor_score`, restricted to identity edges
+        with an endpoint in entity_ids"""
+        tx.run(GraphDBPipeline.NEIGHBOR_SCORE_FOR_QUERY, ids=entity_ids)
+
+    NEIGHBOR_SCORE_FOR_QUERY = """
+    UNWIND $ids AS id
+    MATCH (n:Entity {entity_id: id})-[ident:Identity]-()
+    WITH DISTINCT ident
+    WHERE ident.score > 0.98
+    WITH ident, startNode(ident) AS s, endNode(ident) AS e
+    WITH ident,
+    CASE WHEN elementId(s) < elementId(e) THEN s ELSE e END AS a,
+    CASE WHEN elementId(s) < elementId(e) THEN e ELSE s END AS b
+    MATCH (a)-[:Contribution]->(common)-[:Contribution]-(b)
+    WITH a, b, ident, count(common) AS commonNeighbors
+    MATCH (a)-[:Contribution]->(aContributions)
+    WITH a, b, ident, commonNeighbors, count(distinct aContributions) AS aNeighborCount
+    MATCH (b)-[:Contribution]->(bContributions)
+    WITH ident, commonNeighbors, aNeighborCount, count(distinct bContributions) AS bNeighborCount
+    SET ident.neighbor_score = toFloat(commonNeighbors) / ((aNeighborCount + bNeighborCount))
+    """
+
 
 
 parser = argparse.ArgumentParser()
@@ -256,24 +973,158 @@ parser.add_argument("--score-collapse-min", type=float,
 parser.add_argument("--name-score-collapse-min", type=float,
                     help="Name score threshold above which "\
                     "identity relationships will be collapsed", default=0.99)
-parser.add_argument("--row-index", type=int,
+parser.add_argument("--row-index", type=int, default=0,
                     help="Row index of table to start from")
+parser.add_argument("--delta", action="store_true",
+                    help="Skip rows ingested by an earlier run that haven't "\
+                    "changed since, tracked by hashes of their mapped columns")
+parser.add_argument("--fingerprint-file", type=str, default=None,
+                    help="Row hashes used by --delta, defaults to "\
+                    "fingerprints/TABLE_NAME.npz")
+parser.add_argument("--resume", action="store_true",
+                    help="Start from the first row not yet committed to the "\
+                    "checkpoint file")
+parser.add_argument("--checkpoint-file", type=str, default=None,
+                    help="Manifest recording how far the table has been "\
+                    "ingested, defaults to checkpoints/TABLE_NAME.json")
+parser.add_argument("--embedding-cache", type=str, default=None,
+                    help="Directory of a persistent embedding cache to use")
+parser.add_argument("--embedding-cache-size", type=int, default=1_000_000,
+                    help="Max number of vectors kept in the embedding cache")
+parser.add_argument("--embedding-workers", type=int, default=None,
+                    help="Number of embedding worker processes. If not given "\
+                    "the model runs in the main process")
+parser.add_argument("--embedding-batch-size", type=int, default=64,
+                    help="Number of texts embedded at a time by a worker or the "\
+                    "ONNX model")
+parser.add_argument("--onnx-model-dir", type=str, default=None,
+                    help="Directory of an int8 ONNX export of the embedding "\
+                    "model to embed with instead, see onnx_embedding.py")
+parser.add_argument("--pipelined", action="store_true",
+                    help="Run the ingest steps concurrently as a staged pipeline")
+parser.add_argument("--no-dedup", action="store_true",
+                    help="Create a node for every entity even if an identical "\
+                    "one was already written")
+parser.add_argument("--client-ann", action="store_true",
+                    help="Find identity edge candidates with an in process ANN "\
+                    "index instead of the database's vector index")
+parser.add_argument("--ann-nprobe", type=int, default=8,
+                    help="Number of clusters searched per query by the in "\
+                    "process ANN index")
+parser.add_argument("--blocking", action="store_true",
+                    help="Only score identity candidates sharing a blocking key "\
+                    "(phonetic last name with first initial or zip prefix, "\
+                    "first name token with state). Implies --client-ann")
+parser.add_argument("--max-block-size", type=int, default=2000,
+                    help="Blocks bigger than this are not used to find "\
+                    "candidates")
+parser.add_argument("--neighbor-score", type=str, default="incremental",
+                    choices=["incremental", "full", "sparse"],
+                    help="Rescore only identity edges of nodes whose "\
+                    "contributions changed this run, every identity edge, or "\
+                    "every identity edge outside the database")
+parser.add_argument("--reject-file", type=str, default=None,
+                    help="csv file to write rows whose entity types could not "\
+                    "be resolved to")
+parser.add_argument("--bulk-export", type=str, default=None,
+                    help="Directory to write neo4j-admin import files to "\
+                    "instead of loading the graph db")
+parser.add_argument("--bulk-format", type=str, default="csv",
+                    choices=["csv", "parquet"],
+                    help="Format of the --bulk-export files")
+parser.add_argument("--post-import", action="store_true",
+                    help="Add identity edges, collapse clusters and assign "\
+                    "neighbor scores in a graph loaded from --bulk-export files")
 args = parser.parse_args()
 
 if __name__ == "__main__":
-    embedding = EntityEmbedder()
-    vector_db = Neo4jVector.from_existing_graph(embedding=embedding,
-                            username=st.secrets.neo4j.user,
-                            password=st.secrets.neo4j.pwd,
-                            url=st.secrets.neo4j.uri,
-                            node_label="Entity",
-                            embedding_node_property="embedding",
-                            text_node_properties = ["text"],
-                            pre_delete_collection=False
-                        )
-    pipeline = GraphDBPipeline(vector_db, st.connection("snowflake"))
+    cache = None
+    if args.embedding_cache is not None:
+        cache = EmbeddingCache(args.embedding_cache,
+                               capacity=args.embedding_cache_size)
+    if args.onnx_model_dir is not None:
+        # The full precision model isn't loaded alongside the ONNX one
+        encoder = OnnxEncoder(args.onnx_model_dir,
+                              batch_size=args.embedding_batch_size)
+        embedding = EntityEmbedder(cache=cache, model_name=encoder.model_name,
+                                   encoder=encoder)
+    else:
+        embedding = EntityEmbedder(cache=cache)
+    if args.onnx_model_dir is None and args.embedding_workers is not None:
+        embedding.encoder = EmbeddingWorkerPool(
+            embedding.model_name, num_workers=args.embedding_workers,
+            batch_size=args.embedding_batch_size,
+            cache_folder=embedding.cache_folder,
+            model_kwargs=embedding.model_kwargs,
+            encode_kwargs=embedding.encode_kwargs)
+    # Bulk exports are written without connecting to the graph db
+    exporting = args.bulk_export is not None and not args.post_import
+    vector_db = None
+    if not exporting:
+        vector_db = Neo4jVector.from_existing_graph(embedding=embedding,
+                                username=st.secrets.neo4j.user,
+                                password=st.secrets.neo4j.pwd,
+                                url=st.secrets.neo4j.uri,
+                                node_label="Entity",
+                                embedding_node_property="embedding",
+                                text_node_properties = ["text"],
+                                pre_delete_collection=False
+                            )
+    pipeline = GraphDBPipeline(vector_db, st.connection("snowflake"),
+                               embedding=embedding)
     table_key = TableDataKey(args.table_key)
-    pipeline.process_snowflake_table(table_key,
-                                     csv_file=args.csv_file,
-                                     relationship_type=table_key.relationship_type,
-                                     row_index=5100)
+    checkpoint = IngestCheckpoint(
+        args.checkpoint_file or f"checkpoints/{table_key.table_name}.json",
+        args.table_key, GraphDBPipeline.table_query(table_key),
+        table_key.order_by, csv_file=args.csv_file)
+    row_index = args.row_index
+    fingerprints = None
+    if args.delta:
+        fingerprints = RowFingerprints(
+            args.fingerprint_file or
+            f"fingerprints/{table_key.table_name}.npz",
+            table_key.columns, key_columns=table_key.row_key)
+    if args.resume:
+        if os.path.exists(checkpoint.path):
+            row_index = checkpoint.resume()
+            print(f"Resuming from row {row_index}")
+        else:
+            print(f"No checkpoint at {checkpoint.path}, starting from row "
+                  f"{row_index}")
+    identity_index = None
+    # Identity candidates of exported nodes are found by post_import
+    if (args.client_ann or args.blocking) and not exporting:
+        blocker = None
+        if args.blocking:
+            blocker = Blocker(max_block_size=args.max_block_size)
+        identity_index = IdentityIndex(blocker=blocker, nprobe=args.ann_nprobe)
+        pipeline.load_identity_index(identity_index)
+    if args.post_import:
+        pipeline.post_import(table_key, identity_index=identity_index,
+                             neighbor_score="full" if args.neighbor_score ==
+                             "full" else "sparse")
+    else:
+        exporter = None
+        if exporting:
+            exporter = BulkExporter(args.bulk_export,
+                                    file_format=args.bulk_format)
+        pipeline.process_snowflake_table(table_key,
+                                         csv_file=args.csv_file,
+                                         relationship_type=table_key.relationship_type,
+                                         row_index=row_index,
+                                         reject_file=args.reject_file,
+                                         pipelined=args.pipelined,
+                                         dedup=not args.no_dedup,
+                                         identity_index=identity_index,
+                                         neighbor_score=args.neighbor_score,
+                                         checkpoint=checkpoint,
+                                         fingerprints=fingerprints,
+                                         exporter=exporter)
+    if identity_index is not None and identity_index.blocker is not None:
+        print(identity_index.blocker)
+    if cache is not None:
+        cache.flush()
+        print(cache)
+    if isinstance(embedding.encoder, EmbeddingWorkerPool):
+        embedding.encoder.close()
+        print(embedding.encoder)
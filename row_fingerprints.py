@@ -0,0 +1,156 @@
+from typing import List, Optional
+from collections import Counter
+from pathlib import Path
+from decimal import Decimal
+from hashlib import md5
+
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+
+def _normalize(value) -> str:
+    """Same string for numbers read back as int, float or Decimal and for
+    all kinds of nulls"""
+    if value is None or value is pd.NA or value != value:
+        return ""
+    if isinstance(value, (float, Decimal)):
+        value = float(value)
+        if value.is_integer():
+            value = int(value)
+    return str(value)
+
+
+class RowIds:
+
+    def __init__(self, columns: List[str],
+                 key_columns: Optional[List[str]] = None):
+        """Ids of a table's rows derived from their content, so a row keeps
+        its id however the rows around it change between reloads. Rows are
+        identified by their key columns if the table has any, otherwise by
+        their values and how many identical rows came before them. Rows must
+        be passed in table order, and a run started part way through the
+        table counts identical rows from its first row
+        Args:
+            columns: Columns whose values identify a row without key columns,
+                normally every column the table key reads
+            key_columns: Columns identifying a row across reloads
+        """
+        self.columns = list(columns)
+        self.key_columns = key_columns
+        # Number of times each row seen so far occurred, by digest
+        self._seen = Counter()
+
+    def __call__(self, df: pd.DataFrame) -> np.ndarray:
+        columns = self.key_columns or self.columns
+        digests = [md5("\x1f".join([_normalize(value) for value in
+                                     row]).encode("utf-8")).digest() for row
+                   in df[columns].to_numpy(dtype=object)]
+        if self.key_columns is not None:
+            return np.array([digest.hex() for digest in digests],
+                            dtype=object)
+        ids = []
+        for digest in digests:
+            ids.append(md5(digest + str(self._seen[digest]).encode("utf-8"))
+                       .hexdigest())
+            self._seen[digest] += 1
+        return np.array(ids, dtype=object)
+
+
+class RowFingerprints:
+
+    def __init__(self, path: str, columns: List[str],
+                 key_columns: Optional[List[str]] = None):
+        """Store of hashes of the rows of a table already ingested, so reloads
+        only process inserted or changed rows. Without key columns rows are
+        identified by their content alone, and a row is unchanged if an
+        identical row was ingested before, counting repeats
+        Args:
+            path: npz file the fingerprints are kept in
+            columns: Columns whose values make up a row's fingerprint,
+                normally every column the table key reads
+            key_columns: Columns identifying a row across reloads. If given, a
+                row with a known key but a new fingerprint counts as changed
+        """
+        self.path = Path(path)
+        self.columns = list(columns)
+        self.key_columns = key_columns
+        # Fingerprints as of the start of the run, by key or with their
+        # number of occurrences
+        self._stored = {}
+        self._seen = Counter()
+        self._new = {} if key_columns is not None else Counter()
+        self._lock = threading.Lock()
+        self.skipped = 0
+        self.added = 0
+        self.changed = 0
+        if self.path.exists():
+            self.load()
+
+    @staticmethod
+    def _hash(df: pd.DataFrame, columns: List[str]) -> np.ndarray:
+        # Hash the string form so values read back as different dtypes, e.g.
+        # from csv or Snowflake, hash the same
+        rows = ["\x1f".join([_normalize(value) for value in row]) for row in
+                df[columns].to_numpy(dtype=object)]
+        return pd.util.hash_pandas_object(pd.Series(rows, dtype=object),
+                                          index=False).to_numpy()
+
+    def load(self):
+        with np.load(self.path) as stored:
+            self._stored = dict(zip(stored["keys"].tolist(),
+                                    stored["values"].tolist()))
+
+    def split(self, df: pd.DataFrame) -> np.ndarray:
+        """Mask of the rows of df that are new or changed"""
+        fingerprints = self._hash(df, self.columns)
+        if self.key_columns is None:
+            keep = np.ones(len(df), dtype=bool)
+            for i, fingerprint in enumerate(fingerprints.tolist()):
+                keep[i] = self._seen[fingerprint] >= \
+                    self._stored.get(fingerprint, 0)
+                self._seen[fingerprint] += 1
+            self.skipped += int((~keep).sum())
+            self.added += int(keep.sum())
+            return keep
+
+        keys = self._hash(df, self.key_columns)
+        known = np.array([key in self._stored for key in keys.tolist()],
+                         dtype=bool)
+        unchanged = np.array([self._stored.get(key) == fingerprint for key,
+                              fingerprint in zip(keys.tolist(),
+                                                 fingerprints.tolist())],
+                             dtype=bool)
+        self.skipped += int(unchanged.sum())
+        self.changed += int((known & ~unchanged).sum())
+        self.added += int((~known).sum())
+        return ~unchanged
+
+    def record(self, df: pd.DataFrame):
+        """Add the fingerprints of rows that have been ingested"""
+        fingerprints = self._hash(df, self.columns).tolist()
+        with self._lock:
+            if self.key_columns is None:
+                self._new.update(fingerprints)
+            else:
+                keys = self._hash(df, self.key_columns).tolist()
+                self._new.update(zip(keys, fingerprints))
+
+    def save(self):
+        with self._lock:
+            stored = dict(self._stored)
+            if self.key_columns is None:
+                for fingerprint, count in self._new.items():
+                    stored[fingerprint] = stored.get(fingerprint, 0) + count
+            else:
+                stored.update(self._new)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.stem + ".tmp.npz")
+        np.savez(tmp_path, keys=np.array(list(stored.keys()), dtype=np.uint64),
+                 values=np.array(list(stored.values()), dtype=np.uint64))
+        os.replace(tmp_path, self.path)
+
+    def __str__(self):
+        return f"Delta ingest: {self.skipped} rows unchanged and skipped, "\
+            f"{self.added} added, {self.changed} changed"